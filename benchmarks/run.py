@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""run.py: benchmarks of the messages storage hot path
+
+Runs against a throwaway SQLite database and prints the results as JSON:
+
+    $ python benchmarks/run.py --sizes 0,10,1000,100000 --repeat 5 --output results.json
+
+Every benchmark reports the number of queries of one run and the min, median
+and mean duration, in milliseconds, of ``--repeat`` runs. Compare the output
+of two releases to spot regressions.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.contrib.messages.storage import default_storage  # noqa: E402
+from django.db import connection, reset_queries  # noqa: E402
+from django.http import HttpResponse  # noqa: E402
+from django.template import Context, Template  # noqa: E402
+from django.test import Client, RequestFactory  # noqa: E402
+from django.test.utils import CaptureQueriesContext, setup_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+
+from messages_extends import constants  # noqa: E402
+from messages_extends.models import Message  # noqa: E402
+
+DEFAULT_SIZES = (0, 10, 1000, 100000)
+ALERTS = Template('{% include "messages_extends/includes/alerts_bootstrap.html" %}')
+
+
+def measure(name, func, repeat, setup=None, **info):
+    """
+    Runs ``func`` once to count its queries and ``repeat`` more times to
+    time it. ``setup`` builds the argument of each run and is not timed.
+    """
+    arg = setup() if setup else None
+    # The query log is bounded and requests reset it: start empty and count
+    # before the timed runs.
+    reset_queries()
+    with CaptureQueriesContext(connection) as queries:
+        func(arg)
+    num_queries = len(queries)
+    durations = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg)
+        durations.append((time.perf_counter() - start) * 1000)
+    result = {
+        'name': name,
+        'queries': num_queries,
+        'repeat': repeat,
+        'min_ms': round(min(durations), 3),
+        'median_ms': round(statistics.median(durations), 3),
+        'mean_ms': round(statistics.mean(durations), 3),
+    }
+    result.update(info)
+    return result
+
+
+def make_request(user):
+    request = RequestFactory().get('/')
+    request.user = user
+    request.session = {}
+    return request
+
+
+def make_user(username, size):
+    user = User.objects.create(username=username)
+    Message.objects.bulk_create(
+        (Message(user=user, level=constants.INFO_PERSISTENT, message='Message %d' % i)
+         for i in range(size)), batch_size=1000)
+    return user
+
+
+def storage_benchmarks(user, size, repeat):
+    def loaded_storage():
+        storage = default_storage(make_request(user))
+        list(storage)
+        return storage
+
+    return [
+        measure('construct', lambda _: default_storage(make_request(user)), repeat,
+                messages=size),
+        measure('get', lambda storage: storage._get(), repeat,
+                setup=lambda: default_storage(make_request(user)), messages=size),
+        measure('iterate', lambda storage: list(storage), repeat,
+                setup=lambda: default_storage(make_request(user)), messages=size),
+        measure('store', lambda storage: storage.update(HttpResponse()), repeat,
+                setup=loaded_storage, messages=size),
+        measure('render', lambda storage: ALERTS.render(Context({'messages': storage})), repeat,
+                setup=lambda: default_storage(make_request(user)), messages=size),
+    ]
+
+
+def add_benchmarks(user, repeat):
+    levels = (
+        ('add_persistent', constants.INFO_PERSISTENT),
+        ('add_sticky', constants.INFO_STICKY),
+        ('add_normal', constants.INFO),
+    )
+
+    def add(level):
+        def run(storage):
+            storage.add(level, 'Added message')
+            storage.update(HttpResponse())
+        return run
+
+    return [measure(name, add(level), repeat,
+                    setup=lambda: default_storage(make_request(user)))
+            for name, level in levels]
+
+
+def view_benchmarks(user, repeat):
+    client = Client()
+    client.force_login(user)
+    message = Message.objects.create(user=user, level=constants.INFO_PERSISTENT, message='Read me')
+    mark_read = reverse('message_mark_read', kwargs={'message_id': message.pk})
+
+    def unread(_=None):
+        Message.objects.filter(user=user).update(read=False)
+
+    return [
+        measure('view_mark_read', lambda _: client.get(mark_read), repeat, setup=unread),
+        measure('view_mark_all_read', lambda _: client.get(reverse('message_mark_all_read')),
+                repeat, setup=unread),
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='Comma separated numbers of stored messages per user.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per benchmark.')
+    parser.add_argument('--output', help='Write the results to this file instead of stdout.')
+    options = parser.parse_args(argv)
+    sizes = [int(size) for size in options.sizes.split(',')]
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        results = []
+        for size in sizes:
+            user = make_user('user%d' % size, size)
+            results.extend(storage_benchmarks(user, size, options.repeat))
+        user = make_user('writer', 0)
+        results.extend(add_benchmarks(user, options.repeat))
+        results.extend(view_benchmarks(user, options.repeat))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    report = {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'sizes': sizes,
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
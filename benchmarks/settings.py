@@ -0,0 +1,5 @@
+# Django settings for the benchmarks, see benchmarks/run.py.
+from tests.test_settings import *  # noqa
+
+ROOT_URLCONF = 'benchmarks.urls'
+DEBUG = False
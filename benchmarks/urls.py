@@ -0,0 +1,7 @@
+from django.conf.urls import include
+from django.urls import path
+
+# Not namespaced, like the bundled template expects.
+urlpatterns = [
+    path('messages/', include('messages_extends.urls')),
+]
@@ -17,6 +17,18 @@ def add_message(request, level, message, extra_tags='', fail_silently=False, *ar
 messages.add_message = add_message
 
 
+async def aadd_message(request, level, message, extra_tags='', fail_silently=False, *args, **kwargs):
+    """
+    Async version of ``add_message``, persistent messages are saved with the
+    async ORM.
+    """
+    if hasattr(request, '_messages'):
+        return await request._messages.aadd(level, message, extra_tags, *args, **kwargs)
+    if not fail_silently:
+        raise MessageFailure('You cannot add messages without installing '
+                             'django.contrib.messages.middleware.MessageMiddleware')
+
+
 def persistant_debug(request, message, extra_tags='', fail_silently=False, *args, **kwargs):
     """
     Adds a persistant message with the ``DEBUG`` level.
@@ -66,3 +78,66 @@ def persistant_error(request, message, extra_tags='', fail_silently=False, *args
 
 messages.persistant_error = persistant_error
 
+
+
+def bulk_add(users, level, message, extra_tags='', expires=None, batch_size=1000, dedup_key=None):
+    """
+    Adds a persistent message for many users without a request.
+
+    ``users`` may be a queryset of users, which is streamed as primary keys
+    only, or any iterable of users or user ids. Messages are inserted with
+    one ``bulk_create`` per ``batch_size`` users. Users who already have a
+    message with ``dedup_key`` are skipped. Returns the number of messages
+    created.
+    """
+    from itertools import islice
+    from django.db import transaction
+    from django.db.models import QuerySet
+    from messages_extends import cache, counters, notifications, retention
+    from messages_extends.exceptions import LevelOfMessageException
+    from messages_extends.models import Message as PersistentMessage, insert_messages
+
+    if int(level) not in PERSISTENT_MESSAGE_LEVELS:
+        raise LevelOfMessageException()
+    if isinstance(users, QuerySet):
+        user_ids = users.values_list('pk', flat=True).iterator(chunk_size=batch_size)
+    else:
+        user_ids = (getattr(user, 'pk', user) for user in users)
+
+    created = 0
+    while True:
+        batch = list(islice(user_ids, batch_size))
+        if not batch:
+            return created
+        objs = [PersistentMessage(user_id=user_id, level=level, message=message,
+                                  extra_tags=extra_tags, expires=expires, dedup_key=dedup_key)
+                for user_id in batch]
+        for obj in objs:
+            obj._prepare_message()
+        with transaction.atomic():
+            objs = insert_messages(objs, batch_size=batch_size)
+            added = [obj.user_id for obj in objs]
+            if objs and counters.is_counted(objs[0]):
+                counters.increment(added, expires=expires)
+            retention.enforce(added)
+            notifications.publish(objs)
+        cache.invalidate_many(added)
+        created += len(objs)
+
+
+def broadcast(level, message, extra_tags='', expires=None, group=None, users=None):
+    """
+    Adds a persistent message stored once for many users: the members of
+    ``group`` and ``users``, or everybody when neither is given. Returns the
+    ``Broadcast``.
+    """
+    from messages_extends.exceptions import LevelOfMessageException
+    from messages_extends.models import Broadcast
+
+    if int(level) not in PERSISTENT_MESSAGE_LEVELS:
+        raise LevelOfMessageException()
+    instance = Broadcast.objects.create(level=level, message=message, extra_tags=extra_tags,
+                                        expires=expires, group=group)
+    if users is not None:
+        instance.users.set(users)
+    return instance
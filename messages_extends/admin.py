@@ -1,10 +1,146 @@
 # -*- coding: utf-8 -*-
 """admin.py: messages extends"""
 
-from messages_extends.models import Message
+import json
+
+from messages_extends import archive, cache, counters
+from messages_extends.models import ArchivedMessage, Broadcast, Message, MessageTag
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+# Below this many rows COUNT(*) is cheap, and planner estimates are rough.
+ESTIMATE_THRESHOLD = 10000
+
+
+def estimate_count(queryset):
+    """
+    Returns the number of rows of ``queryset`` estimated by the database,
+    or ``None`` when the backend has no estimates: the table statistics for
+    a whole table, and on PostgreSQL the plan of a filtered queryset.
+    """
+    connection = connections[queryset.db]
+    if queryset.query.where:
+        if connection.vendor != 'postgresql':
+            return None
+        return int(json.loads(queryset.explain(format='json'))[0]['Plan']['Plan Rows'])
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE oid = %s::regclass'
+    elif connection.vendor == 'mysql':
+        sql = ('SELECT table_rows FROM information_schema.tables '
+               'WHERE table_schema = DATABASE() AND table_name = %s')
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    # PostgreSQL reports -1 for tables never analyzed.
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Takes the size of a large changelist from the database estimates rather
+    than counting the rows; small ones are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        estimate = estimate_count(self.object_list)
+        if estimate is not None and estimate > ESTIMATE_THRESHOLD:
+            return estimate
+        return super(EstimatedCountPaginator, self).count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Changelist settings for tables of messages: users are joined, the table
+    is not counted twice, and searches only use indexed columns.
+    """
+    list_select_related = ['user']
+    raw_id_fields = ['user']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    search_fields = ['=user__username']
+    search_help_text = 'A username, a message id or a user id.'
+
+    def get_search_results(self, request, queryset, search_term):
+        # Message bodies are not searched, that would scan the table.
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        condition = Q(user__username=search_term)
+        if search_term.isdigit():
+            condition |= Q(pk=search_term) | Q(user_id=search_term)
+        return queryset.filter(condition), False
+
 
-class MessageAdmin(admin.ModelAdmin):
+class MessageAdmin(LargeTableAdmin):
     list_display = ['level', 'user', 'message', 'created', 'read']
+    list_filter = ['level', 'read', 'created']
+    actions = ['mark_read', 'expire', 'purge']
+
+    def _changed_users(self, queryset):
+        return set(queryset.order_by().values_list('user_id', flat=True).distinct())
+
+    @admin.action(description='Mark selected messages as read')
+    def mark_read(self, request, queryset):
+        queryset = queryset.filter(read=False)
+        user_ids = self._changed_users(queryset)
+        updated = queryset.update(read=True, modified=timezone.now())
+        counters.invalidate(user_ids)
+        cache.invalidate_many(user_ids)
+        self.message_user(request, '%d messages marked as read.' % updated)
+
+    @admin.action(description='Expire selected messages')
+    def expire(self, request, queryset):
+        now = timezone.now()
+        queryset = queryset.filter(Q(expires=None) | Q(expires__gt=now))
+        user_ids = self._changed_users(queryset)
+        updated = queryset.update(expires=now, modified=now)
+        counters.invalidate(user_ids)
+        cache.invalidate_many(user_ids)
+        self.message_user(request, '%d messages expired.' % updated)
+
+    @admin.action(description='Delete selected messages that are read or expired')
+    def purge(self, request, queryset):
+        # Neither kind is counted nor shown, so the counters and the cache
+        # stay right and the rows can go by batches of plain DELETEs (after
+        # their tags), without loading them for the signals.
+        queryset = queryset.filter(Q(read=True) | Q(expires__lte=timezone.now()))
+        connection = connections[queryset.db]
+        tables = [(connection.ops.quote_name(MessageTag._meta.db_table),
+                   connection.ops.quote_name(MessageTag._meta.get_field('message').column)),
+                  (connection.ops.quote_name(Message._meta.db_table),
+                   connection.ops.quote_name(Message._meta.pk.column))]
+        deleted = 0
+        for pks in archive.batches(queryset):
+            placeholders = ', '.join(['%s'] * len(pks))
+            with transaction.atomic(using=queryset.db), connection.cursor() as cursor:
+                for table, column in tables:
+                    cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (table, column, placeholders),
+                                   pks)
+                deleted += cursor.rowcount
+        self.message_user(request, '%d messages deleted.' % deleted)
 
 admin.site.register(Message, MessageAdmin)
+
+
+class BroadcastAdmin(admin.ModelAdmin):
+    list_display = ['level', 'message', 'group', 'created', 'expires']
+    raw_id_fields = ['users']
+
+admin.site.register(Broadcast, BroadcastAdmin)
+
+
+class ArchivedMessageAdmin(LargeTableAdmin):
+    list_display = ['level', 'user', 'message', 'created', 'archived']
+    list_filter = ['level', 'archived']
+
+admin.site.register(ArchivedMessage, ArchivedMessageAdmin)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""archive.py: messages extends
+
+Moves read messages from the ``Message`` table, which is queried on every
+request, to the ``ArchivedMessage`` table. Run the ``archive_messages``
+command periodically, or archive messages as soon as they are read with::
+
+    MESSAGES_ARCHIVE_ON_READ = True
+
+Either way only messages created more than ``MESSAGES_ARCHIVE_AFTER_DAYS``
+(30 by default) days ago are moved.
+"""
+
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from messages_extends.models import ArchivedMessage, Message
+
+# Columns copied to the archive, the id included.
+FIELDS = ('id', 'user_id', 'message', 'level', 'extra_tags', 'created', 'modified', 'read',
+          'expires')
+BATCH_SIZE = 1000
+AFTER_DAYS = 30
+
+
+def enabled():
+    """
+    Whether messages are archived when they are marked as read.
+    """
+    return getattr(settings, 'MESSAGES_ARCHIVE_ON_READ', False)
+
+
+def get_threshold(days=None):
+    """
+    Returns the creation date before which read messages are archived.
+    """
+    if days is None:
+        days = getattr(settings, 'MESSAGES_ARCHIVE_AFTER_DAYS', AFTER_DAYS)
+    return timezone.now() - datetime.timedelta(days=days)
+
+
+def batches(queryset, batch_size=BATCH_SIZE):
+    """
+    Yields the pks of ``queryset`` in lists of ``batch_size``, by pk.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        pks = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        last_pk = pks[-1]
+        yield pks
+
+
+def archive(pks, before=None):
+    """
+    Moves the read messages among ``pks``, created before ``before`` if
+    given, to the archive. Returns the number of messages moved.
+    """
+    with transaction.atomic():
+        rows = Message.objects.filter(pk__in=pks, read=True)
+        if before is not None:
+            rows = rows.filter(created__lt=before)
+        archived = [ArchivedMessage(**row) for row in rows.values(*FIELDS)]
+        if not archived:
+            return 0
+        # A message archived before is never in both tables, but a retried
+        # batch must not fail.
+        ArchivedMessage.objects.bulk_create(archived, ignore_conflicts=True)
+        Message.objects.filter(pk__in=[message.pk for message in archived]).delete()
+    return len(archived)
+
+
+def archive_on_read(pks, batch_size=BATCH_SIZE):
+    """
+    Archives the messages ``pks`` just marked as read, when
+    ``MESSAGES_ARCHIVE_ON_READ`` is set and they are old enough. Returns the
+    number of messages moved.
+    """
+    if not enabled():
+        return 0
+    pks = list(pks)
+    before = get_threshold()
+    return sum(archive(pks[start:start + batch_size], before)
+               for start in range(0, len(pks), batch_size))
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""async_urls.py: messages extends
+
+Same urls as ``messages_extends.urls``, with the mark read and stream views
+served by their async versions. Include this module instead of ``urls``
+under ASGI.
+"""
+
+from django.urls import re_path, path
+from messages_extends.urls import urlpatterns as sync_urlpatterns
+from messages_extends.views import amessage_mark_all_read, amessage_mark_read, amessage_stream
+urlpatterns = [
+    path('stream/', amessage_stream, name='message_stream'),
+    re_path(r'^mark_read/(?P<message_id>\d+)/$', amessage_mark_read, name='message_mark_read'),
+    path('mark_read/all/', amessage_mark_all_read, name='message_mark_all_read'),
+] + sync_urlpatterns
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""cache.py: messages extends
+
+Optional per-user cache of the active persistent messages. Enable it with::
+
+    MESSAGES_PERSISTENT_CACHE = 'default'  # any alias of settings.CACHES
+
+Entries are keyed by user and a version token; invalidating a user drops the
+token, so entries computed before the write are never served again.
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+VERSION_KEY = 'messages_extends:version:%s'
+BROADCASTS_VERSION_KEY = 'messages_extends:version:broadcasts'
+MESSAGES_KEY = 'messages_extends:messages:%s:%s:%s'
+RENDERED_KEY = 'messages_extends:rendered:%s:%s'
+STATE_VERSION_KEY = 'messages_extends:version:state'
+STATE_KEY = 'messages_extends:state:%s:%s:%s:%s'
+LISTING_KEY = 'messages_extends:listing:%s:%s:%s'
+DEFAULT_TIMEOUT = 300
+
+
+def md5(data=b''):
+    """
+    Return an md5 hash object for keys and ETags. FIPS builds only allow md5
+    with ``usedforsecurity=False``, which Python < 3.9 doesn't accept.
+    """
+    try:
+        return hashlib.md5(data, usedforsecurity=False)
+    except TypeError:
+        return hashlib.md5(data)
+
+
+def get_cache():
+    """
+    Return the configured cache, or ``None`` when caching is disabled.
+    """
+    alias = getattr(settings, 'MESSAGES_PERSISTENT_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def get_version(cache, key):
+    """
+    Return the current version token stored at ``key``, creating one if
+    needed.
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def get_timeout(messages):
+    """
+    Return the cache timeout for ``messages``: the configured timeout, cut
+    short by the earliest expiry date so expired messages are never served.
+    """
+    expires = [message.expires for message in messages if message.expires is not None]
+    return _timeout_until(min(expires, default=None))
+
+
+def _timeout_until(expires):
+    timeout = getattr(settings, 'MESSAGES_PERSISTENT_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+    if expires is not None:
+        remaining = (expires - timezone.now()).total_seconds()
+        if timeout is None or remaining < timeout:
+            timeout = int(remaining)
+    return timeout
+
+
+def _messages_key(user_id, versions):
+    # Broadcasts are shared by all users, so they have a version of their own.
+    return MESSAGES_KEY % (user_id, versions[VERSION_KEY % user_id],
+                           versions[BROADCASTS_VERSION_KEY])
+
+
+def get_versions(cache, keys):
+    """
+    Return the version tokens stored at ``keys``, creating the missing ones.
+    """
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            versions[key] = get_version(cache, key)
+    return versions
+
+
+def get_messages(user_id, loader):
+    """
+    Return the cached messages of the user, calling ``loader`` to build the
+    list on a miss.
+    """
+    cache = get_cache()
+    if cache is None:
+        return loader()
+    versions = get_versions(cache, [VERSION_KEY % user_id, BROADCASTS_VERSION_KEY])
+    key = _messages_key(user_id, versions)
+    messages = cache.get(key)
+    if messages is None:
+        messages = list(loader())
+        timeout = get_timeout(messages)
+        if timeout is None or timeout > 0:
+            cache.set(key, messages, timeout)
+    return messages
+
+
+async def aget_messages(user_id, loader):
+    """
+    Async version of ``get_messages``, ``loader`` is a coroutine function.
+    """
+    cache = get_cache()
+    if cache is None:
+        return await loader()
+    version_keys = [VERSION_KEY % user_id, BROADCASTS_VERSION_KEY]
+    versions = await cache.aget_many(version_keys)
+    for version_key in version_keys:
+        if version_key not in versions:
+            await cache.aadd(version_key, time.time_ns(), None)
+            versions[version_key] = await cache.aget(version_key)
+    key = _messages_key(user_id, versions)
+    messages = await cache.aget(key)
+    if messages is None:
+        messages = await loader()
+        timeout = get_timeout(messages)
+        if timeout is None or timeout > 0:
+            await cache.aset(key, messages, timeout)
+    return messages
+
+
+def _state_key(cache, user_id):
+    # The state version lets reconcile_message_cache drop every entry at once.
+    keys = [VERSION_KEY % user_id, BROADCASTS_VERSION_KEY, STATE_VERSION_KEY]
+    versions = get_versions(cache, keys)
+    return STATE_KEY % ((user_id,) + tuple(versions[key] for key in keys))
+
+
+def get_state(user_id, loader):
+    """
+    Return the active messages of the user kept by ``CachedPersistentStorage``,
+    calling ``loader`` on a miss. Entries do not time out: expired messages
+    are left out when read.
+    """
+    cache = get_cache()
+    key = _state_key(cache, user_id)
+    messages = cache.get(key)
+    if messages is None:
+        messages = list(loader())
+        cache.set(key, messages, None)
+    now = timezone.now()
+    return [message for message in messages
+            if message.expires is None or message.expires > now]
+
+
+def set_state(user_id, loader):
+    """
+    Store the messages returned by ``loader`` as the state of the user, e.g.
+    right after writing them.
+    """
+    cache = get_cache()
+    key = _state_key(cache, user_id)
+    cache.set(key, list(loader()), None)
+
+
+def invalidate_states():
+    """
+    Discard the state of every user.
+    """
+    cache = get_cache()
+    if cache is not None:
+        cache.delete(STATE_VERSION_KEY)
+
+
+def get_rendered(user_id, messages, variant, render):
+    """
+    Return ``render(messages)``, cached for the user under a digest of the
+    message set: creating, reading or expiring a message changes the set, so
+    stale HTML is never looked up again. ``variant`` tells apart renderings
+    of the same messages (template, language...).
+    """
+    cache = get_cache()
+    if cache is None or not messages:
+        return render(messages)
+    digest = md5(variant.encode())
+    for message in messages:
+        digest.update(('|%s:%s:%s' % (message.is_broadcast, message.pk,
+                                      message.modified.isoformat())).encode())
+    key = RENDERED_KEY % (user_id, digest.hexdigest())
+    rendered = cache.get(key)
+    if rendered is None:
+        rendered = render(messages)
+        timeout = get_timeout(messages)
+        if timeout is None or timeout > 0:
+            cache.set(key, rendered, timeout)
+    return rendered
+
+
+def get_listing(user_id, variant, loader):
+    """
+    Return ``loader()``, a summary of the messages of the user listed with
+    ``variant``, cached until the messages of the user are written or the
+    first of them expires: ``loader`` returns a dict whose ``valid_until``
+    is the earliest expiry date of the listed messages.
+    """
+    cache = get_cache()
+    if cache is None:
+        return loader()
+    version = get_version(cache, VERSION_KEY % user_id)
+    key = LISTING_KEY % (user_id, version,
+                         md5(variant.encode()).hexdigest())
+    listing = cache.get(key)
+    if listing is None:
+        listing = loader()
+        timeout = _timeout_until(listing['valid_until'])
+        if timeout is None or timeout > 0:
+            cache.set(key, listing, timeout)
+    return listing
+
+
+def invalidate(user_id):
+    """
+    Discard the cached messages of a user.
+    """
+    cache = get_cache()
+    if cache is not None and user_id is not None:
+        cache.delete(VERSION_KEY % user_id)
+
+
+async def ainvalidate(user_id):
+    cache = get_cache()
+    if cache is not None and user_id is not None:
+        await cache.adelete(VERSION_KEY % user_id)
+
+
+def invalidate_many(user_ids):
+    """
+    Discard the cached messages of several users at once.
+    """
+    cache = get_cache()
+    if cache is not None:
+        cache.delete_many([VERSION_KEY % user_id for user_id in user_ids
+                           if user_id is not None])
+
+
+def invalidate_broadcasts():
+    """
+    Discard the cached messages of every user after a broadcast changed.
+    """
+    cache = get_cache()
+    if cache is not None:
+        cache.delete(BROADCASTS_VERSION_KEY)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""counters.py: messages extends
+
+Per-user counters of unread persistent messages, so badges can be rendered
+without counting rows of the message table.
+
+A counter holds the number of unread, unexpired messages of the user and is
+valid until the earliest ``expires`` among them. Writes adjust it with ``F()``
+expressions; a missing or outdated counter is rebuilt on the next read.
+"""
+
+from django.contrib.auth import get_user_model
+from django.db import connections, router, transaction
+from django.db.models import Case, Count, F, Min, Q, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from messages_extends.archive import batches
+from messages_extends.models import Message, UnreadCount
+
+
+def is_counted(message):
+    """
+    Whether ``message`` is part of the unread counter of its user.
+    """
+    return message.user_id is not None and not message.read and\
+        (message.expires is None or message.expires > timezone.now())
+
+
+def get_unread_count(user):
+    """
+    Returns the number of unread persistent messages of ``user``.
+    """
+    user_id = getattr(user, 'pk', user)
+    if user_id is None:
+        return 0
+    counter = UnreadCount.objects.filter(user_id=user_id).\
+        values_list('count', 'valid_until').first()
+    if counter is not None:
+        count, valid_until = counter
+        if valid_until is None or valid_until > timezone.now():
+            return count
+    return rebuild(user_id)
+
+
+def rebuild(user_id):
+    """
+    Counts the unread messages of a user and stores the result.
+    """
+    now = timezone.now()
+    counted = Message.objects.\
+        filter(Q(expires=None) | Q(expires__gt=now), user_id=user_id, read=False).\
+        aggregate(count=Count('pk'), valid_until=Min('expires'))
+    UnreadCount.objects.update_or_create(user_id=user_id, defaults=counted)
+    return counted['count']
+
+
+def _rebuild_batch(user_ids, unread):
+    # One short transaction per batch, so only these counters are locked.
+    using = router.db_for_write(UnreadCount)
+    with transaction.atomic(using=using):
+        counted = [UnreadCount(user_id=row['user'], count=row['count'],
+                               valid_until=row['valid_until'])
+                   for row in unread.filter(user_id__in=user_ids).order_by().values('user').
+                   annotate(count=Count('pk'), valid_until=Min('expires'))]
+        stale = UnreadCount.objects.filter(user_id__in=user_ids).\
+            exclude(user_id__in=[counter.user_id for counter in counted])
+        if getattr(connections[using].features, 'supports_update_conflicts_with_target', False):
+            # Updated in place, so concurrent F() increments wait and apply.
+            stale.delete()
+            UnreadCount.objects.bulk_create(counted, update_conflicts=True, unique_fields=['user'],
+                                            update_fields=['count', 'valid_until'])
+        else:
+            # Django < 4.1 or no upsert: replace the counters of the batch; a
+            # counter rebuilt lazily meanwhile is kept.
+            UnreadCount.objects.filter(user_id__in=user_ids).delete()
+            UnreadCount.objects.bulk_create(counted, ignore_conflicts=True)
+    return len(counted)
+
+
+def rebuild_all(batch_size=1000):
+    """
+    Rebuilds the counters of all users with unread messages or a counter,
+    ``batch_size`` users per transaction, so writes are never held up for
+    the whole run. Returns the number of counters stored.
+    """
+    now = timezone.now()
+    unread = Message.objects.filter(Q(expires=None) | Q(expires__gt=now), read=False)
+    users = get_user_model().objects.filter(Q(pk__in=unread.values('user')) |
+                                            Q(pk__in=UnreadCount.objects.values('user')))
+    return sum(_rebuild_batch(user_ids, unread) for user_ids in batches(users, batch_size))
+
+
+def _increment_values(by, expires):
+    values = {'count': F('count') + by}
+    if expires is not None:
+        values['valid_until'] = Case(
+            When(Q(valid_until=None) | Q(valid_until__gt=expires), then=Value(expires)),
+            default=F('valid_until'))
+    return values
+
+
+def increment(user_ids, by=1, expires=None):
+    """
+    Adds ``by`` unread messages expiring at ``expires`` to the counters of
+    ``user_ids``.
+    """
+    UnreadCount.objects.filter(user_id__in=user_ids).update(**_increment_values(by, expires))
+
+
+async def aincrement(user_ids, by=1, expires=None):
+    await UnreadCount.objects.filter(user_id__in=user_ids).aupdate(**_increment_values(by, expires))
+
+
+def decrement(user_ids, by=1):
+    """
+    Removes ``by`` unread messages from the counters of ``user_ids``.
+    """
+    UnreadCount.objects.filter(user_id__in=user_ids).\
+        update(count=Greatest(F('count') - by, Value(0)))
+
+
+async def adecrement(user_ids, by=1):
+    await UnreadCount.objects.filter(user_id__in=user_ids).\
+        aupdate(count=Greatest(F('count') - by, Value(0)))
+
+
+def reset(user_ids):
+    """
+    Sets the counters of ``user_ids`` to zero, e.g. after marking all their
+    messages as read.
+    """
+    UnreadCount.objects.filter(user_id__in=user_ids).update(count=0, valid_until=None)
+
+
+async def areset(user_ids):
+    await UnreadCount.objects.filter(user_id__in=user_ids).aupdate(count=0, valid_until=None)
+
+
+def invalidate(user_ids):
+    """
+    Drops the counters of ``user_ids``; they are rebuilt on the next read.
+    """
+    UnreadCount.objects.filter(user_id__in=user_ids).delete()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""instrumentation.py: messages extends
+
+Reports the time and the queries spent by the storages and views, so the
+latency of a page can be attributed to this app. Listen to the
+``operation_finished`` signal::
+
+    from messages_extends.instrumentation import operation_finished
+
+    @receiver(operation_finished)
+    def record(sender, operation, backend, duration, queries, messages, **kwargs):
+        ...
+
+or set a callback, called with the same keyword arguments::
+
+    MESSAGES_METRICS_CALLBACK = 'myproject.metrics.record_messages'
+
+``operation`` is ``'get'``, ``'store'`` or ``'process_message'`` for a
+single backend of ``FallbackStorage``, ``'add'`` for a whole ``add()`` call
+and the view name for views. ``backend`` is the storage class, if any.
+``duration`` is in seconds; ``queries`` and ``messages`` are ``None`` when
+they are unknown. Operations that raise are not reported, and nothing is
+measured while nobody listens.
+"""
+
+import asyncio
+import time
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+# Set on the request by ServerTimingMiddleware.
+TIMINGS_ATTR = '_messages_timings'
+
+operation_finished = Signal()
+
+
+class Measurement(object):
+    """
+    Counts the queries of one operation; callers set ``messages``.
+    """
+
+    def __init__(self):
+        self.queries = None
+        self.messages = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+def get_callback():
+    """
+    Returns the configured metrics callback, or ``None``.
+    """
+    path = getattr(settings, 'MESSAGES_METRICS_CALLBACK', None)
+    if path is None:
+        return None
+    if callable(path):
+        return path
+    return import_string(path)
+
+
+@contextmanager
+def measure(operation, request=None, backend=None, count_queries=True):
+    """
+    Times the enclosed block and reports it. Yields a ``Measurement`` whose
+    ``messages`` attribute the block can set.
+    """
+    measurement = Measurement()
+    timings = getattr(request, TIMINGS_ATTR, None)
+    callback = get_callback()
+    if timings is None and callback is None and not operation_finished.has_listeners():
+        yield measurement
+        return
+    with ExitStack() as stack:
+        if count_queries:
+            measurement.queries = 0
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(measurement))
+        start = time.perf_counter()
+        yield measurement
+        duration = time.perf_counter() - start
+    metrics = {
+        'operation': operation,
+        'backend': backend,
+        'duration': duration,
+        'queries': measurement.queries,
+        'messages': measurement.messages,
+    }
+    if timings is not None:
+        timings.append(metrics)
+    if callback is not None:
+        callback(**metrics)
+    operation_finished.send(sender=backend, **metrics)
+
+
+def instrument_view(view):
+    """
+    Reports the calls of ``view``. Queries are not counted for async views,
+    their queries run on connections of other threads.
+    """
+    if asyncio.iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            with measure(view.__name__, request, count_queries=False):
+                return await view(request, *args, **kwargs)
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            with measure(view.__name__, request):
+                return view(request, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""archive_messages.py: messages extends"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from messages_extends import archive
+from messages_extends.models import Message
+
+
+class Command(BaseCommand):
+    help = ('Moves read messages created more than --days days ago to the archive table, '
+            'in batches of primary keys so no long lock is held.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Archive read messages created more than DAYS days ago '
+                                 '(MESSAGES_ARCHIVE_AFTER_DAYS, 30 by default).')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of messages moved per transaction.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to wait between batches.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many messages would be archived.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive number.')
+        queryset = Message.objects.filter(read=True,
+                                          created__lt=archive.get_threshold(options['days']))
+
+        archived = 0
+        for pks in archive.batches(queryset, batch_size):
+            if options['dry_run']:
+                archived += len(pks)
+            else:
+                archived += archive.archive(pks)
+            if options['verbosity'] > 1:
+                self.stdout.write('%d messages so far.' % archived)
+            if options['sleep'] and len(pks) == batch_size:
+                time.sleep(options['sleep'])
+
+        if options['dry_run']:
+            self.stdout.write('%d messages would be archived.' % archived)
+        else:
+            self.stdout.write('Archived %d messages.' % archived)
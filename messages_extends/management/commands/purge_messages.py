@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""purge_messages.py: messages extends"""
+
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+
+from messages_extends.models import Message
+
+
+class Command(BaseCommand):
+    help = ('Deletes expired messages and, with --days, read messages older than that, '
+            'in batches of primary keys so no long lock is held.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Also delete read messages created more than DAYS days ago.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of messages deleted per query.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to wait between batches.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many messages would be deleted.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive number.')
+        now = timezone.now()
+        condition = Q(expires__lte=now)
+        if options['days'] is not None:
+            condition |= Q(read=True, created__lt=now - datetime.timedelta(days=options['days']))
+        queryset = Message.objects.filter(condition).order_by('pk')
+
+        deleted = 0
+        last_pk = None
+        while True:
+            batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            pks = list(batch.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            if not options['dry_run']:
+                Message.objects.filter(pk__in=pks).delete()
+            deleted += len(pks)
+            if options['verbosity'] > 1:
+                self.stdout.write('%d messages so far.' % deleted)
+            if options['sleep'] and len(pks) == batch_size:
+                time.sleep(options['sleep'])
+
+        if options['dry_run']:
+            self.stdout.write('%d messages would be deleted.' % deleted)
+        else:
+            self.stdout.write('Deleted %d messages.' % deleted)
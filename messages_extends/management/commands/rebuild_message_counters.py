@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""rebuild_message_counters.py: messages extends"""
+
+from django.core.management.base import BaseCommand
+
+from messages_extends import counters
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the unread message counters of all users from the messages table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of users whose counters are rebuilt per transaction.')
+
+    def handle(self, *args, **options):
+        rebuilt = counters.rebuild_all(batch_size=options['batch_size'])
+        self.stdout.write('Rebuilt %d unread message counters.' % rebuilt)
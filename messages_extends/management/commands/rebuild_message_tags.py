@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""rebuild_message_tags.py: messages extends"""
+
+from django.core.management.base import BaseCommand
+
+from messages_extends import tags
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the tag lookup table from the extra_tags of all messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of tags inserted per query.')
+
+    def handle(self, *args, **options):
+        rebuilt = tags.rebuild_all(batch_size=options['batch_size'])
+        self.stdout.write('Rebuilt %d message tags.' % rebuilt)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""reconcile_message_cache.py: messages extends"""
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.http import HttpRequest
+from django.utils import timezone
+
+from messages_extends import cache
+from messages_extends.models import Message
+from messages_extends.storages import CachedPersistentStorage
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the cached messages of CachedPersistentStorage from the messages table: '
+            'drops every entry, then loads the users with unread messages.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users',
+                            help='Only rebuild the entry of this user id (repeatable).')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of users loaded per query.')
+
+    def handle(self, *args, **options):
+        if cache.get_cache() is None:
+            raise CommandError('The MESSAGES_PERSISTENT_CACHE setting is not set.')
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive number.')
+        user_ids = options['users']
+        if user_ids:
+            cache.invalidate_many(user_ids)
+        else:
+            cache.invalidate_states()
+            user_ids = Message.objects.\
+                filter(Q(expires=None) | Q(expires__gt=timezone.now()),
+                       user__isnull=False, read=False).\
+                order_by('user').values_list('user', flat=True).distinct()
+            user_ids = list(user_ids)
+
+        loaded = 0
+        for start in range(0, len(user_ids), batch_size):
+            for user in get_user_model().objects.filter(pk__in=user_ids[start:start + batch_size]):
+                request = HttpRequest()
+                request.user = user
+                storage = CachedPersistentStorage(request)
+                cache.set_state(user.pk, storage._load_messages)
+                loaded += 1
+        self.stdout.write('Rebuilt the cached messages of %d users.' % loaded)
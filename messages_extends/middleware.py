@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""middleware.py: messages extends"""
+
+from django.utils.deprecation import MiddlewareMixin
+
+from messages_extends.instrumentation import TIMINGS_ATTR
+
+
+class ServerTimingMiddleware(MiddlewareMixin):
+    """
+    Adds a ``Server-Timing`` header with the time spent by the message
+    storages and views, e.g.::
+
+        Server-Timing: messages-get;dur=1.42;desc="PersistentStorage, 2 queries, 3 messages"
+
+    Place it before ``MessageMiddleware`` so the storing of the messages,
+    done when the response passes through ``MessageMiddleware``, is included.
+    """
+
+    def process_request(self, request):
+        setattr(request, TIMINGS_ATTR, [])
+
+    def process_response(self, request, response):
+        timings = getattr(request, TIMINGS_ATTR, None)
+        if timings:
+            entries = [self.format_timing(timing) for timing in timings]
+            if response.has_header('Server-Timing'):
+                entries.insert(0, response['Server-Timing'])
+            response['Server-Timing'] = ', '.join(entries)
+        return response
+
+    def format_timing(self, timing):
+        description = []
+        if timing['backend'] is not None:
+            description.append(timing['backend'].__name__)
+        if timing['queries'] is not None:
+            description.append('%d queries' % timing['queries'])
+        if timing['messages'] is not None:
+            description.append('%d messages' % timing['messages'])
+        entry = 'messages-%s;dur=%.2f' % (timing['operation'], timing['duration'] * 1000)
+        if description:
+            entry += ';desc="%s"' % ', '.join(description)
+        return entry
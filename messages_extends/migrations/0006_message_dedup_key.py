@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messages_extends', '0005_archivedmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='dedup_key',
+            field=models.CharField(blank=True, max_length=128, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='insert_token',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('dedup_key__isnull', False)), fields=('user', 'dedup_key'), name='messages_ext_dedup_unique'),
+        ),
+    ]
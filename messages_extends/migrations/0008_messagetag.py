@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messages_extends', '0007_message_created_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tag', models.CharField(max_length=128)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='message_tags', to='messages_extends.message')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='messagetag',
+            constraint=models.UniqueConstraint(fields=('tag', 'message'), name='messages_ext_tag_unique'),
+        ),
+    ]
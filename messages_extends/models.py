@@ -1,14 +1,45 @@
 # -*- coding: utf-8 -*-
 """models.py: messages extends"""
 
+import datetime
+import uuid
+
 import messages_extends
-from django.db import models
+from messages_extends import cache
+from django.db import connections, models, router
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import force_str
 from django.contrib.messages import utils
 from django.conf import settings
 
 LEVEL_TAGS = utils.get_level_tags()
 
+
+def get_tags(level, extra_tags, read):
+    """
+    Returns the css classes of a message: its extra tags, the tag of its
+    level and whether it was read.
+    """
+    label_tag = force_str(LEVEL_TAGS.get(level, ''),
+        strings_only=True)
+    extra_tags = force_str(extra_tags, strings_only=True)
+
+    if read:
+        read_tag = "read"
+    else:
+        read_tag = "unread"
+
+    if extra_tags and label_tag:
+        return u' '.join([extra_tags, label_tag, read_tag])
+    elif extra_tags:
+        return u' '.join([extra_tags, read_tag])
+    elif label_tag:
+        return u' '.join([label_tag, read_tag])
+    return read_tag
+
+
 class Message(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True,
                              on_delete=models.CASCADE)
@@ -26,9 +57,54 @@ class Message(models.Model):
     modified = models.DateTimeField(auto_now=True)
     read = models.BooleanField(default=False)
     expires = models.DateTimeField(null=True, blank=True)
+    dedup_key = models.CharField(max_length=128, null=True, blank=True)
+    # Set by insert_messages to find the rows it inserted.
+    insert_token = models.UUIDField(null=True, blank=True, editable=False)
+
+    is_broadcast = False
+
+    class Meta:
+        constraints = [
+            # A user gets one message per key, see insert_messages.
+            # Partial, as almost every message has no key.
+            models.UniqueConstraint(fields=['user', 'dedup_key'],
+                                    condition=models.Q(dedup_key__isnull=False),
+                                    name='messages_ext_dedup_unique'),
+        ]
+        indexes = [
+            # Serves the unread lookup of ``PersistentStorage`` on backends
+            # without partial indexes, and everywhere the read messages of a
+            # user by date (``message_list?read=1``), which the partial index
+            # below doesn't hold.
+            models.Index(fields=['user', 'read', 'created'],
+                         name='messages_ext_user_read_idx'),
+            # Only covers unread rows, so it stays small no matter how many
+            # read messages a user accumulates.
+            models.Index(fields=['user', 'created'], condition=models.Q(read=False),
+                         name='messages_ext_unread_idx'),
+            # Serve the date, read and level filters of the admin over all
+            # users; the indexes above lead with the user.
+            models.Index(fields=['created'], name='messages_ext_created_idx'),
+            models.Index(fields=['read', 'created'], name='messages_ext_read_idx'),
+            models.Index(fields=['level', 'created'], name='messages_ext_level_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Message, cls).from_db(db, field_names, values)
+        instance._remember_state()
+        return instance
+
+    def _remember_state(self):
+        """
+        Keeps the values the unread counters and the tags depend on, to tell
+        what a later ``save()`` changed.
+        """
+        self._loaded_state = (self.__dict__.get('user_id'), self.__dict__.get('read'),
+                              self.__dict__.get('expires'), self.__dict__.get('extra_tags'))
 
     def __eq__(self, other):
-        return isinstance(other, Message) and self.level == other.level and\
+        return isinstance(other, (Message, StoredMessage)) and self.level == other.level and\
                self.message == other.message
 
     __hash__ = models.Model.__hash__
@@ -52,21 +128,367 @@ class Message(models.Model):
         super(Message, self).save(*args, **kwargs)
 
     def _get_tags(self):
-        label_tag = force_str(LEVEL_TAGS.get(self.level, ''),
-            strings_only=True)
-        extra_tags = force_str(self.extra_tags, strings_only=True)
+        return get_tags(self.level, self.extra_tags, self.read)
 
-        if self.read:
-            read_tag = "read"
-        else:
-            read_tag = "unread"
+    tags = property(_get_tags)
+
+
+class ArchivedMessage(models.Model):
+    """
+    A read message moved out of the ``Message`` table by the
+    ``archive_messages`` command or ``MESSAGES_ARCHIVE_ON_READ``, keeping
+    its id so both tables can be listed together.
+    """
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True,
+                             on_delete=models.CASCADE, related_name='+')
+    message = models.TextField()
+    level = models.IntegerField(choices=Message.LEVEL_CHOICES)
+    extra_tags = models.CharField(max_length=128)
+    created = models.DateTimeField()
+    modified = models.DateTimeField()
+    read = models.BooleanField(default=True)
+    expires = models.DateTimeField(null=True, blank=True)
+    archived = models.DateTimeField(auto_now_add=True)
+
+    is_broadcast = False
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created'], name='messages_ext_archive_user_idx'),
+        ]
+
+    def __str__(self):
+        return force_str(self.message)
+
+    def _get_tags(self):
+        return get_tags(self.level, self.extra_tags, self.read)
+
+    tags = property(_get_tags)
+
+
+class StoredMessage(object):
+    """
+    Read-only stand-in for an unread ``Message`` row, built from
+    ``values_list`` when ``MESSAGES_PERSISTENT_LIGHTWEIGHT`` is set. It has
+    what templates and storages use (``pk``, ``level``, ``message``,
+    ``tags``...) without the cost of a model instance, and only the columns
+    needed: ``created``, ``modified`` and ``expires`` are ``None`` unless
+    asked for, see ``get_fields``.
+    """
+    __slots__ = ('pk', 'level', 'message', 'extra_tags', 'created', 'modified', 'expires')
+
+    # Columns of the constructor, in order; ``get_fields`` returns a prefix.
+    FIELDS = ('pk', 'level', 'message', 'extra_tags', 'created', 'modified', 'expires')
+
+    is_broadcast = False
+    # Only unread messages are loaded.
+    read = False
+
+    def __init__(self, pk, level, message, extra_tags, created=None, modified=None, expires=None):
+        self.pk = pk
+        self.level = level
+        self.message = message
+        self.extra_tags = extra_tags
+        self.created = created
+        self.modified = modified
+        self.expires = expires
+
+    @classmethod
+    def get_fields(cls, broadcasts=False, cached=False):
+        """
+        Returns the columns to load: ``created`` to merge the messages with
+        broadcasts, and ``modified`` and ``expires`` for the cache keys and
+        timeouts.
+        """
+        if cached:
+            return cls.FIELDS
+        if broadcasts:
+            return cls.FIELDS[:5]
+        return cls.FIELDS[:4]
+
+    @classmethod
+    def from_queryset(cls, queryset, fields=FIELDS):
+        return [cls(*row) for row in queryset.values_list(*fields)]
+
+    @property
+    def id(self):
+        return self.pk
+
+    def __eq__(self, other):
+        return isinstance(other, (Message, StoredMessage)) and self.level == other.level and\
+               self.message == other.message
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __str__(self):
+        return force_str(self.message)
+
+    def __repr__(self):
+        return '<StoredMessage: %s>' % self.pk
+
+    def _get_tags(self):
+        return get_tags(self.level, self.extra_tags, self.read)
+
+    tags = property(_get_tags)
+
+
+class UnreadCount(models.Model):
+    """
+    Denormalized number of unread messages of a user, see ``counters``.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, primary_key=True,
+                                on_delete=models.CASCADE, related_name='+')
+    count = models.PositiveIntegerField(default=0)
+    valid_until = models.DateTimeField(null=True, blank=True)
+
+
+class Broadcast(models.Model):
+    """
+    A persistent message shown to many users, stored once.
+
+    It targets the members of ``group`` and the listed ``users``; when neither
+    is set it targets all users. Who has read it is kept in
+    ``BroadcastReceipt`` rows.
+    """
+    message = models.TextField()
+    level = models.IntegerField(choices=Message.LEVEL_CHOICES)
+    extra_tags = models.CharField(max_length=128, blank=True)
+    group = models.ForeignKey('auth.Group', blank=True, null=True,
+                              on_delete=models.CASCADE, related_name='+')
+    users = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True, related_name='+')
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+    expires = models.DateTimeField(null=True, blank=True)
+
+    is_broadcast = True
+    read = False
+
+    def __str__(self):
+        return force_str(self.message)
+
+    def _prepare_message(self):
+        self.message = force_str(self.message, strings_only=True)
+        self.extra_tags = force_str(self.extra_tags, strings_only=True)
+
+    def save(self, *args, **kwargs):
+        self._prepare_message()
+        super(Broadcast, self).save(*args, **kwargs)
 
-        if extra_tags and label_tag:
-            return u' '.join([extra_tags, label_tag, read_tag])
-        elif extra_tags:
-            return u' '.join([extra_tags, read_tag])
-        elif label_tag:
-            return u' '.join([label_tag, read_tag])
-        return read_tag
+    def _get_tags(self):
+        return get_tags(self.level, self.extra_tags, self.read)
 
     tags = property(_get_tags)
+
+
+class BroadcastReceipt(models.Model):
+    """
+    Records that ``user`` read ``broadcast``.
+    """
+    broadcast = models.ForeignKey(Broadcast, on_delete=models.CASCADE, related_name='receipts')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'broadcast'],
+                                    name='messages_ext_receipt_unique'),
+        ]
+
+
+class MessageTag(models.Model):
+    """
+    One of the space separated ``extra_tags`` of a message, so messages can
+    be looked up by tag through an index, see ``messages_extends.tags``.
+    """
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='message_tags')
+    tag = models.CharField(max_length=128)
+
+    class Meta:
+        constraints = [
+            # Also the index of the lookups by tag.
+            models.UniqueConstraint(fields=['tag', 'message'], name='messages_ext_tag_unique'),
+        ]
+
+
+def split_tags(extra_tags):
+    """
+    Returns the distinct tags of ``extra_tags``, in order.
+    """
+    return list(dict.fromkeys((extra_tags or '').split()))
+
+
+def build_message_tags(messages):
+    """
+    Returns unsaved ``MessageTag`` instances for the saved ``messages``.
+    """
+    return [MessageTag(message_id=message.pk, tag=tag)
+            for message in messages if message.pk is not None
+            for tag in split_tags(message.extra_tags)]
+
+
+def insert_messages(messages, batch_size=None):
+    """
+    Inserts unsaved ``Message`` instances with ``bulk_create`` and returns the
+    ones inserted, with their pk. Their tags are inserted too.
+
+    Messages with a ``dedup_key`` the user already has are skipped by the
+    database, as the insert ignores conflicts.
+    """
+    inserted = _insert_messages(messages, batch_size)
+    MessageTag.objects.bulk_create(build_message_tags(inserted), batch_size=batch_size)
+    return inserted
+
+
+def _insert_messages(messages, batch_size):
+    plain = [message for message in messages if not message.dedup_key]
+    keyed = {}
+    for message in messages:
+        if message.dedup_key:
+            keyed.setdefault((message.user_id, message.dedup_key), message)
+    connection = connections[router.db_for_write(Message)]
+    if keyed and not connection.features.supports_partial_indexes:
+        # No constraint backs the keys (MySQL), skip the ones already used.
+        existing = set(Message.objects.filter(
+            user_id__in=set(user_id for user_id, key in keyed),
+            dedup_key__in=set(key for user_id, key in keyed)).values_list('user_id', 'dedup_key'))
+        keyed = dict((pair, message) for pair, message in keyed.items() if pair not in existing)
+    # Ignoring conflicts leaves the pks unset, as do backends that don't
+    # return the inserted rows: those messages are found by a token each.
+    found = list(keyed.values())
+    if not connection.features.can_return_rows_from_bulk_insert:
+        found += plain
+    for message in found:
+        message.insert_token = uuid.uuid4()
+    if plain:
+        Message.objects.bulk_create(plain, batch_size=batch_size)
+    if keyed:
+        Message.objects.bulk_create(list(keyed.values()), batch_size=batch_size,
+                                    ignore_conflicts=True)
+    _find_inserted(found, batch_size or 1000)
+    return [message for message in messages if message.pk is not None]
+
+
+def _find_inserted(messages, batch_size):
+    # Sets the pk of the ``messages`` inserted, by their ``insert_token``.
+    for start in range(0, len(messages), batch_size):
+        batch = dict((message.insert_token, message)
+                     for message in messages[start:start + batch_size])
+        # Bounds the lookup to the rows just created, less a second as some
+        # backends store truncated timestamps.
+        since = min(message.created for message in batch.values()) - datetime.timedelta(seconds=1)
+        rows = Message.objects.filter(user_id__in=set(message.user_id for message in batch.values()),
+                                      created__gte=since, insert_token__in=list(batch)).\
+            values_list('insert_token', 'pk')
+        for token, pk in rows:
+            batch[token].pk = pk
+
+
+def broadcasts_enabled():
+    """
+    Whether broadcasts are shown, ``MESSAGES_BROADCASTS``. Off by default,
+    as looking them up costs a query per request.
+    """
+    return getattr(settings, 'MESSAGES_BROADCASTS', False)
+
+
+def broadcasts_for(user, include_read=False):
+    """
+    Returns a queryset of the unexpired broadcasts targeting ``user``, by
+    default only the ones the user has not read.
+    """
+    targets = models.Q(group=None, users=None) | models.Q(users=user)
+    if hasattr(user, 'groups'):
+        targets |= models.Q(group__in=user.groups.all())
+    qs = Broadcast.objects.\
+        filter(models.Q(expires=None) | models.Q(expires__gt=timezone.now())).\
+        filter(targets)
+    if not include_read:
+        qs = qs.exclude(receipts__user=user)
+    return qs.distinct().order_by('created', 'pk')
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def invalidate_cached_messages(sender, instance, **kwargs):
+    """
+    Keeps the optional message cache in sync with saves and deletes,
+    including edits made through the admin.
+    """
+    cache.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=Message)
+def update_message_tags(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Keeps the ``MessageTag`` rows of a message in sync with its
+    ``extra_tags``. Runs before ``update_unread_count_on_save``, which
+    records the saved values.
+    """
+    if not created:
+        if update_fields is not None and 'extra_tags' not in update_fields:
+            return
+        loaded_state = getattr(instance, '_loaded_state', None)
+        if loaded_state is not None and loaded_state[3] == instance.__dict__.get('extra_tags'):
+            return
+        MessageTag.objects.filter(message=instance).delete()
+    MessageTag.objects.bulk_create(build_message_tags([instance]))
+
+
+@receiver(post_save, sender=Message)
+def update_unread_count_on_save(sender, instance, created, **kwargs):
+    """
+    Adjusts the unread counter of the user when a message is created or its
+    read flag changes; any other change makes the counter be rebuilt.
+    """
+    from messages_extends import counters
+
+    loaded_state = getattr(instance, '_loaded_state', None)
+    instance._remember_state()
+    if created:
+        if counters.is_counted(instance):
+            counters.increment([instance.user_id], expires=instance.expires)
+        return
+    if loaded_state is None:
+        counters.invalidate([instance.user_id])
+        return
+    user_id, read, expires, extra_tags = loaded_state
+    if user_id != instance.user_id or expires != instance.expires:
+        counters.invalidate([user_id, instance.user_id])
+    elif read != instance.read and (expires is None or expires > timezone.now()):
+        if instance.read:
+            counters.decrement([instance.user_id])
+        else:
+            counters.increment([instance.user_id])
+
+
+@receiver(post_save, sender=Message)
+def publish_created_message(sender, instance, created, **kwargs):
+    """
+    Notifies the subscribers of ``message_stream`` about new messages.
+    """
+    from messages_extends import notifications
+
+    if created:
+        notifications.publish([instance])
+
+
+@receiver(post_delete, sender=Message)
+def update_unread_count_on_delete(sender, instance, **kwargs):
+    from messages_extends import counters
+
+    if counters.is_counted(instance):
+        counters.decrement([instance.user_id])
+
+
+@receiver(post_save, sender=Broadcast)
+@receiver(post_delete, sender=Broadcast)
+@receiver(m2m_changed, sender=Broadcast.users.through)
+def invalidate_cached_broadcasts(sender, instance, **kwargs):
+    cache.invalidate_broadcasts()
+
+
+@receiver(post_save, sender=BroadcastReceipt)
+def invalidate_cached_receipts(sender, instance, **kwargs):
+    cache.invalidate(instance.user_id)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""notifications.py: messages extends
+
+Publishes newly created persistent messages to the users they belong to,
+for the ``message_stream`` view. The bus is pluggable::
+
+    MESSAGES_NOTIFICATION_BUS = 'messages_extends.notifications.InProcessBus'
+
+``InProcessBus`` only reaches subscribers in the same process; deployments
+with several processes need a bus backed by a shared broker.
+"""
+
+import asyncio
+import queue
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from messages_extends.models import get_tags
+
+DEFAULT_BUS = 'messages_extends.notifications.InProcessBus'
+
+_buses = {}
+_buses_lock = threading.Lock()
+
+
+class Subscription(object):
+    """
+    Events published for one user, in order, until ``close()`` is called.
+    """
+
+    def __init__(self, bus, user_id, maxsize=100):
+        self.bus = bus
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=maxsize)
+        self._waiter = None
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # Slow consumers lose events rather than blocking publishers; the
+            # stream replays missed messages from the database on reconnect.
+            pass
+        waiter = self._waiter
+        if waiter is not None:
+            loop, ready = waiter
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                # The loop of the consumer is closed.
+                pass
+
+    def get(self, timeout=None):
+        """
+        Returns the next event, or ``None`` if none arrived within ``timeout``
+        seconds.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    async def aget(self, timeout=None):
+        """
+        Async version of ``get``, waiting on the event loop instead of
+        blocking it.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            try:
+                return self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return None
+            ready = asyncio.Event()
+            self._waiter = (loop, ready)
+            try:
+                # An event put before the waiter was set is taken at once.
+                if self.queue.empty():
+                    await asyncio.wait_for(ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                self._waiter = None
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class BaseBus(object):
+    """
+    Interface of notification buses.
+    """
+
+    def publish(self, user_id, event):
+        raise NotImplementedError('subclasses of BaseBus must provide a publish() method')
+
+    def has_subscribers(self, user_id):
+        """
+        Whether events for ``user_id`` may reach anyone; lets publishers skip
+        building them.
+        """
+        return True
+
+    def subscribe(self, user_id):
+        raise NotImplementedError('subclasses of BaseBus must provide a subscribe() method')
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError('subclasses of BaseBus must provide an unsubscribe() method')
+
+
+class InProcessBus(BaseBus):
+    """
+    Delivers events to subscribers of the current process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def publish(self, user_id, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def has_subscribers(self, user_id):
+        return user_id in self._subscriptions
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, user_id)
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+
+def get_bus():
+    """
+    Returns the configured bus, one instance per process.
+    """
+    path = getattr(settings, 'MESSAGES_NOTIFICATION_BUS', DEFAULT_BUS)
+    with _buses_lock:
+        bus = _buses.get(path)
+        if bus is None:
+            bus = _buses[path] = import_string(path)()
+    return bus
+
+
+def message_event(message):
+    """
+    Returns the JSON serializable event published for ``message``.
+    """
+    return {
+        'id': message.pk,
+        'level': message.level,
+        'message': message.message,
+        'tags': get_tags(message.level, message.extra_tags, message.read),
+        'created': message.created.isoformat() if message.created else None,
+        'expires': message.expires.isoformat() if message.expires else None,
+    }
+
+
+def publish_now(messages):
+    """
+    Publishes the created ``messages`` to their users.
+    """
+    bus = get_bus()
+    for message in messages:
+        if message.user_id is not None and bus.has_subscribers(message.user_id):
+            bus.publish(message.user_id, message_event(message))
+
+
+def publish(messages):
+    """
+    Publishes the created ``messages`` to their users once the current
+    transaction commits.
+    """
+    messages = list(messages)
+    if messages:
+        transaction.on_commit(lambda: publish_now(messages))
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""outbox.py: messages extends
+
+Takes the writes of persistent messages off the request. With::
+
+    MESSAGES_PERSISTENT_OUTBOX = True
+
+added messages are put in an in-process queue once the request transaction
+commits, and background threads insert them in batches. They are shown
+from the next request on, once written. Other settings:
+
+- ``MESSAGES_OUTBOX_WORKERS``: number of threads, 2 by default.
+- ``MESSAGES_OUTBOX_MAXSIZE``: number of batches the queue holds, 1000 by
+  default.
+- ``MESSAGES_OUTBOX_FULL``: what to do when the queue is full. ``'save'``
+  (the default) writes the messages in the request, ``'block'`` waits up to
+  ``MESSAGES_OUTBOX_TIMEOUT`` seconds for room and then writes them, and
+  ``'drop'`` discards them.
+- ``MESSAGES_OUTBOX_SYNC``: writes the messages at once, in the caller; use
+  it in tests.
+
+The queue is drained when the process exits. Messages still queued when a
+process is killed are lost.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger('messages_extends.outbox')
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def enabled():
+    """
+    Whether persistent messages are written through the outbox.
+    """
+    return getattr(settings, 'MESSAGES_PERSISTENT_OUTBOX', False)
+
+
+def _write(messages):
+    from messages_extends.storages import save_messages
+    return save_messages(messages)
+
+
+class Outbox(object):
+    """
+    A bounded queue of message batches, drained by a pool of threads. Each
+    thread writes the batches waiting in the queue together, up to
+    ``batch_size`` messages.
+    """
+
+    def __init__(self, workers=2, maxsize=1000, batch_size=500, write=_write):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.write = write
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _start(self):
+        with self._lock:
+            if self._threads or self._closed:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, daemon=True,
+                                          name='messages-outbox-%d' % index)
+                thread.start()
+                self._threads.append(thread)
+
+    def put(self, messages):
+        """
+        Queues ``messages`` to be written, applying ``MESSAGES_OUTBOX_FULL``
+        when the queue is full.
+        """
+        messages = list(messages)
+        if not messages:
+            return
+        if getattr(settings, 'MESSAGES_OUTBOX_SYNC', False) or self._closed:
+            self.write(messages)
+            return
+        self._start()
+        policy = getattr(settings, 'MESSAGES_OUTBOX_FULL', 'save')
+        try:
+            if policy == 'block':
+                self._queue.put(messages, timeout=getattr(settings, 'MESSAGES_OUTBOX_TIMEOUT', 5))
+            else:
+                self._queue.put_nowait(messages)
+        except queue.Full:
+            if policy == 'drop':
+                logger.warning('Messages outbox full, %d messages dropped.', len(messages))
+            else:
+                self.write(messages)
+
+    def _next_batch(self):
+        batch = self._queue.get()
+        if batch is None:
+            return None, 1
+        taken = 1
+        while len(batch) < self.batch_size:
+            try:
+                more = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if more is None:
+                # Leave the stop marker for after this batch.
+                self._queue.task_done()
+                self._queue.put(None)
+                break
+            batch = batch + more
+            taken += 1
+        return batch, taken
+
+    def _run(self):
+        while True:
+            batch, taken = self._next_batch()
+            if batch is None:
+                self._queue.task_done()
+                break
+            try:
+                self.write(batch)
+            except Exception:
+                logger.exception('Messages outbox failed to write %d messages.', len(batch))
+            finally:
+                close_old_connections()
+                for _ in range(taken):
+                    self._queue.task_done()
+        close_old_connections()
+
+    def flush(self):
+        """
+        Waits until the queued messages are written.
+        """
+        if self._threads:
+            self._queue.join()
+
+    def shutdown(self):
+        """
+        Writes the queued messages and stops the threads. Messages put
+        afterwards are written in the caller.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            threads = list(self._threads)
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+
+def get_outbox():
+    """
+    Returns the outbox of the process, configured from the settings the
+    first time.
+    """
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox(workers=getattr(settings, 'MESSAGES_OUTBOX_WORKERS', 2),
+                             maxsize=getattr(settings, 'MESSAGES_OUTBOX_MAXSIZE', 1000))
+            atexit.register(_outbox.shutdown)
+    return _outbox
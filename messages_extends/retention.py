@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""retention.py: messages extends
+
+Caps the number of unread persistent messages a user can accumulate::
+
+    MESSAGES_PERSISTENT_MAX_UNREAD = 100
+    # or per level, None standing for all levels together
+    MESSAGES_PERSISTENT_MAX_UNREAD = {WARNING_PERSISTENT: 20, None: 100}
+
+Whenever messages are added, the oldest unread messages of their users
+beyond a cap are marked as read, so they stop being shown.
+"""
+
+from django.conf import settings
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from messages_extends import cache, counters
+from messages_extends.models import Message
+
+
+def get_caps():
+    """
+    Returns the configured caps as a ``{level or None: cap}`` dict.
+    """
+    caps = getattr(settings, 'MESSAGES_PERSISTENT_MAX_UNREAD', None)
+    if caps is None:
+        return {}
+    if not isinstance(caps, dict):
+        return {None: caps}
+    return caps
+
+
+def _trim(user_id, level, cap, now):
+    queryset = Message.objects.filter(Q(expires=None) | Q(expires__gt=now),
+                                      user_id=user_id, read=False)
+    if level is not None:
+        queryset = queryset.filter(level=level)
+    overflow = list(queryset.order_by('-created', '-pk').values_list('pk', flat=True)[cap:])
+    return Message.objects.filter(pk__in=overflow, read=False).update(read=True, modified=now)
+
+
+def enforce(user_ids):
+    """
+    Marks as read the oldest unread messages of ``user_ids`` exceeding the
+    caps. Returns the number of messages marked.
+    """
+    caps = get_caps()
+    if not caps:
+        return 0
+    now = timezone.now()
+    unread = Message.objects.filter(Q(expires=None) | Q(expires__gt=now),
+                                    user_id__in=set(user_ids), read=False).order_by()
+    # One grouped query per kind of cap finds the users above it. Level caps
+    # go first, as trimming them may bring a user back under the global cap.
+    exceeded = []
+    level_caps = dict((level, cap) for level, cap in caps.items() if level is not None)
+    if level_caps:
+        for row in unread.filter(level__in=level_caps).values('user', 'level').\
+                annotate(count=Count('pk')):
+            if row['count'] > level_caps[row['level']]:
+                exceeded.append((row['user'], row['level'], level_caps[row['level']]))
+    if None in caps:
+        exceeded.extend((row['user'], None, caps[None]) for row in
+                        unread.values('user').annotate(count=Count('pk')).
+                        filter(count__gt=caps[None]))
+
+    trimmed = 0
+    for user_id, level, cap in exceeded:
+        count = _trim(user_id, level, cap, now)
+        if count:
+            counters.decrement([user_id], by=count)
+            cache.invalidate(user_id)
+            trimmed += count
+    return trimmed
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""routing.py: messages extends
+
+Sends the reads of persistent messages to a replica::
+
+    MESSAGES_READ_DATABASE = 'replica'
+
+Writes still go where the database routers send them. After the messages of
+a user are written (added, marked as read), the reads for that user go to
+the primary for ``MESSAGES_STICKY_SECONDS`` (5 by default), so replication
+lag never shows them a message they just dismissed. The users are
+remembered in the ``MESSAGES_STICKY_CACHE`` cache (``'default'``), which
+must be shared by all the processes.
+
+Messages loaded to fill ``MESSAGES_PERSISTENT_CACHE`` are read from the
+primary, so a lagging replica is never cached.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import router
+
+from messages_extends.models import Message
+
+STICKY_KEY = 'messages_extends:sticky:%s'
+STICKY_SECONDS = 5
+
+
+def get_read_database():
+    """
+    Returns the configured replica alias, or ``None``.
+    """
+    return getattr(settings, 'MESSAGES_READ_DATABASE', None)
+
+
+def get_cache():
+    return caches[getattr(settings, 'MESSAGES_STICKY_CACHE', 'default')]
+
+
+def read_database(user_id):
+    """
+    Returns the alias the messages of ``user_id`` are read from; ``None``
+    stands for the default routing.
+    """
+    alias = get_read_database()
+    if alias is not None and get_cache().get(STICKY_KEY % user_id):
+        return router.db_for_write(Message)
+    return alias
+
+
+async def aread_database(user_id):
+    """
+    Async version of ``read_database``.
+    """
+    alias = get_read_database()
+    if alias is not None and await get_cache().aget(STICKY_KEY % user_id):
+        return router.db_for_write(Message)
+    return alias
+
+
+def _sticky_keys(user_ids):
+    return dict((STICKY_KEY % user_id, True) for user_id in set(user_ids))
+
+
+def stick(user_ids):
+    """
+    Reads the messages of ``user_ids`` from the primary for a while, after
+    they were written.
+    """
+    if get_read_database() is not None:
+        get_cache().set_many(_sticky_keys(user_ids),
+                             getattr(settings, 'MESSAGES_STICKY_SECONDS', STICKY_SECONDS))
+
+
+async def astick(user_ids):
+    """
+    Async version of ``stick``.
+    """
+    if get_read_database() is not None:
+        await get_cache().aset_many(_sticky_keys(user_ids),
+                                    getattr(settings, 'MESSAGES_STICKY_SECONDS', STICKY_SECONDS))
@@ -1,9 +1,43 @@
 $(function() {
+    // Alerts closed within this many milliseconds are marked as read with a
+    // single request.
+    var DELAY = 300;
+    var pending = {}, timer = null;
+
+    function flush() {
+        timer = null;
+        $.each(pending, function (href, ids) {
+            $.post(href, $.param(ids, true), function () {
+            });
+        });
+        pending = {};
+    }
+
     $("a.close[close-href]").click(function (e) {
             e.preventDefault();
-            $.post($(this).attr("close-href"), "", function () {
-            });
+            var bulkHref = $(this).attr("bulk-href");
+            if (!bulkHref) {
+                $.post($(this).attr("close-href"), "", function () {
+                });
+                return;
+            }
+            var ids = pending[bulkHref] = pending[bulkHref] || {id: [], broadcast: []};
+            if ($(this).attr("broadcast-id")) {
+                ids.broadcast.push($(this).attr("broadcast-id"));
+            } else {
+                ids.id.push($(this).attr("message-id"));
+            }
+            if (timer) {
+                clearTimeout(timer);
+            }
+            timer = setTimeout(flush, DELAY);
         }
     );
-});
 
+    $(window).on("pagehide", function () {
+        if (timer) {
+            clearTimeout(timer);
+            flush();
+        }
+    });
+});
@@ -1,12 +1,28 @@
 # -*- coding: utf-8 -*-
 """storages.py: messages extends"""
 
+import binascii
+import json
+from itertools import chain
+from operator import attrgetter
+
+from asgiref.sync import sync_to_async
 from django.utils.module_loading import import_string as get_storage
 from django.contrib.messages.storage.base import BaseStorage, Message
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core import signing
+from django.http import SimpleCookie
+from django.utils.safestring import SafeData, mark_safe
 from django.conf import settings
-from messages_extends.models import Message as PersistentMessage
+from django.core.exceptions import ImproperlyConfigured
+from messages_extends import (cache, counters, instrumentation, notifications, outbox,
+                              retention, routing)
+from messages_extends.models import (Message as PersistentMessage, MessageTag, StoredMessage,
+                                     broadcasts_enabled, broadcasts_for, build_message_tags,
+                                     insert_messages)
 from messages_extends.constants import PERSISTENT_MESSAGE_LEVELS, STICKY_MESSAGE_LEVELS
 from django.contrib.auth.models import AnonymousUser
+from django.db import transaction
 from django.db.models import Q
 try:
     from django.utils import timezone
@@ -15,6 +31,56 @@ except ImportError:
 
 __author__ = 'ali'
 
+
+def _load_user(request):
+    user = request.user
+    # Accessing an attribute evaluates the lazy user of AuthenticationMiddleware.
+    user.is_authenticated
+    return user
+
+
+async def aget_request_user(request):
+    """
+    Returns the user of ``request``, loading it outside the event loop when
+    it was not loaded yet.
+    """
+    if not hasattr(request, 'user'):
+        return AnonymousUser()
+    if hasattr(request, 'auser'):
+        return await request.auser()
+    return await sync_to_async(_load_user)(request)
+
+def _count_unread(messages):
+    """
+    Adds saved messages to the unread counters of their users.
+    """
+    added = {}
+    for message in messages:
+        if counters.is_counted(message):
+            count, expires = added.get(message.user_id, (0, None))
+            if message.expires is not None and (expires is None or message.expires < expires):
+                expires = message.expires
+            added[message.user_id] = (count + 1, expires)
+    for user_id, (count, expires) in added.items():
+        counters.increment([user_id], by=count, expires=expires)
+
+
+def save_messages(messages):
+    """
+    Inserts unsaved persistent ``messages`` in one transaction, skipping the
+    duplicates of their ``dedup_key``, and updates what depends on them.
+    Returns the messages inserted.
+    """
+    with transaction.atomic():
+        saved = insert_messages(messages)
+        _count_unread(saved)
+        retention.enforce(set(message.user_id for message in saved))
+        notifications.publish(saved)
+    user_ids = set(message.user_id for message in saved)
+    transaction.on_commit(lambda: cache.invalidate_many(user_ids))
+    return saved
+
+
 class FallbackStorage(BaseStorage):
     """
     Tries to store all messages in the first backend, storing any unstored
@@ -37,19 +103,62 @@ class FallbackStorage(BaseStorage):
     def __init__(self, *args, **kwargs):
         super(FallbackStorage, self).__init__(*args, **kwargs)
 
-        # get instances of classes of storages_names
-        self.storages = [get_storage(storage)(*args, **kwargs)
-                         for storage in self.storages_names]
+        # Backends are only instantiated when they are first needed, see
+        # _get_storage.
+        self._storage_args = args
+        self._storage_kwargs = kwargs
+        self._storage_instances = {}
 
         self._used_storages = set()
 
+    def _get_storage_class(self, index):
+        return get_storage(self.storages_names[index])
+
+    def _get_storage(self, index):
+        """
+        Returns the backend at ``index``, instantiating it on first use.
+        """
+        storage = self._storage_instances.get(index)
+        if storage is None:
+            storage = self._get_storage_class(index)(*self._storage_args,
+                                                     **self._storage_kwargs)
+            self._storage_instances[index] = storage
+        return storage
+
+    @property
+    def storages(self):
+        """
+        All the backends, instantiating the ones which were not used yet.
+        """
+        return [self._get_storage(index) for index in range(len(self.storages_names))]
+
+    @property
+    def hidden_count(self):
+        """
+        Number of stored messages the backends left out, see
+        ``PersistentStorage.hidden_count``.
+        """
+        self._loaded_messages
+        return sum(getattr(storage, '_hidden_count', 0)
+                   for storage in self._storage_instances.values())
+
     def _get(self, *args, **kwargs):
         """
         Gets a single list of messages from all storage backends.
+
+        Backends whose class sets ``retrieves_messages = False`` never hold
+        messages between requests and are skipped without being created.
         """
         all_messages = []
-        for storage in self.storages:
-            messages, all_retrieved = storage._get()
+        all_retrieved = False
+        for index in range(len(self.storages_names)):
+            if not getattr(self._get_storage_class(index), 'retrieves_messages', True):
+                continue
+            storage = self._get_storage(index)
+            with instrumentation.measure('get', self.request, type(storage)) as measurement:
+                messages, all_retrieved = storage._get()
+                if messages is not None:
+                    measurement.messages = len(messages)
             # If the backend hasn't been used, no more retrieval is necessary.
             if messages is None:
                 break
@@ -70,18 +179,21 @@ class FallbackStorage(BaseStorage):
         For each storage backend, any messages not stored are passed on to the
         next backend.
         """
-        for storage in self.storages:
+        for index in range(len(self.storages_names)):
             if messages:
-                messages = storage._store(messages, response,
-                    remove_oldest=False)
+                storage = self._get_storage(index)
+                with instrumentation.measure('store', self.request, type(storage)) as measurement:
+                    measurement.messages = len(messages)
+                    messages = storage._store(messages, response, remove_oldest=False)
+                continue
             # Even if there are no more messages, continue iterating to ensure
             # storages which contained messages are flushed.
-            elif storage in self._used_storages:
+            storage = self._storage_instances.get(index)
+            if storage is not None and storage in self._used_storages:
                 storage._store([], response)
                 self._used_storages.remove(storage)
         return messages
 
-
     def add(self, level, message, extra_tags='', *args, **kwargs):
         """
         Queues a message to be stored.
@@ -97,12 +209,48 @@ class FallbackStorage(BaseStorage):
             return
             # Add the message
         self.added_new = True
+        with instrumentation.measure('add', self.request) as measurement:
+            measurement.messages = 1
+            message = Message(level, message, extra_tags=extra_tags)
+            for index in range(len(self.storages_names)):
+                if hasattr(self._get_storage_class(index), 'process_message'):
+                    storage = self._get_storage(index)
+                    with instrumentation.measure('process_message', self.request,
+                                                 type(storage)) as processing:
+                        processing.messages = 1
+                        message = storage.process_message(message, *args, **kwargs)
+                    if not message:
+                        # The storage may defer the write until the response
+                        # is stored, so make sure its _store is called.
+                        self._used_storages.add(storage)
+                        return
+            self._queued_messages.append(message)
+
+    async def aadd(self, level, message, extra_tags='', *args, **kwargs):
+        """
+        Async version of ``add``, for backends that define
+        ``aprocess_message``.
+        """
+        if not message:
+            return
+        level = int(level)
+        if level < self.level:
+            return
+        self.added_new = True
         message = Message(level, message, extra_tags=extra_tags)
-        for storage in self.storages:
-            if hasattr(storage, 'process_message'):
+        for index in range(len(self.storages_names)):
+            storage_class = self._get_storage_class(index)
+            if hasattr(storage_class, 'aprocess_message'):
+                storage = self._get_storage(index)
+                message = await storage.aprocess_message(message, *args, **kwargs)
+            elif hasattr(storage_class, 'process_message'):
+                storage = self._get_storage(index)
                 message = storage.process_message(message, *args, **kwargs)
-                if not message:
-                    return
+            else:
+                continue
+            if not message:
+                self._used_storages.add(storage)
+                return
         self._queued_messages.append(message)
 
     def _prepare_messages(self, messages):
@@ -117,26 +265,140 @@ class FallbackStorage(BaseStorage):
 class PersistentStorage(BaseStorage):
     """
     Save persistent messages in data base
+
+    With ``MESSAGES_PERSISTENT_DEFERRED = True`` messages are kept in memory
+    and inserted with a single ``bulk_create`` when the response is stored.
+    With ``MESSAGES_PERSISTENT_OUTBOX = True`` they are written by the
+    threads of the outbox instead.
     """
 
     def __init__(self, request, *args, **kwargs):
         self._sticky_messages = []
+        self._pending_messages = []
+        self._hidden_count = 0
         super(PersistentStorage, self).__init__(request, *args, **kwargs)
 
-    def _message_queryset(self, include_read=False):
+    @property
+    def hidden_count(self):
         """
-        Return a queryset of messages for the request user
+        Number of stored messages left out by ``MESSAGES_PERSISTENT_MAX_SHOWN``.
         """
-        expire = timezone.now()
+        self._loaded_messages
+        return self._hidden_count
+
+    def _message_queryset(self, include_read=False, using=None, user=None):
+        """
+        Return a queryset of messages for ``user`` (the request user by
+        default), read from the ``using`` database
 
+        The user and read filters are applied in a single ``filter()`` call
+        with ``read=False`` (not ``exclude(read=True)``), so the predicate
+        matches the partial index on unread messages; the expiry check is
+        then only evaluated against the user's unread rows.
+        """
+        expire = timezone.now()
 
-        qs = PersistentMessage.objects.\
-        filter(user=self.get_user()).\
-        filter(Q(expires=None) | Q(expires__gt=expire))
+        filters = {'user': user if user is not None else self.get_user()}
         if not include_read:
-            qs = qs.exclude(read=True)
-        return qs
+            filters['read'] = False
+        return PersistentMessage.objects.using(using).\
+            filter(Q(expires=None) | Q(expires__gt=expire), **filters).\
+            order_by('created', 'pk')
+
+    def _broadcast_queryset(self, using=None, user=None):
+        """
+        Return a queryset of the unread broadcasts for ``user`` (the request
+        user by default)
+        """
+        return broadcasts_for(user if user is not None else self.get_user()).using(using)
+
+    def _stored_fields(self):
+        """
+        Columns of the ``StoredMessage`` objects loaded in lightweight mode.
+        """
+        return StoredMessage.get_fields(
+            broadcasts=broadcasts_enabled(),
+            cached=cache.get_cache() is not None)
 
+    def _read_database(self):
+        """
+        Database the messages are loaded from; loads that fill the cache use
+        the primary.
+        """
+        if cache.get_cache() is not None:
+            return None
+        return routing.read_database(self.get_user().pk)
+
+    def _load_messages(self):
+        """
+        Return the messages of the request user merged with the broadcasts
+        targeting them, by creation date.
+        """
+        using = self._read_database()
+        messages = self._message_queryset(using=using)
+        max_shown = getattr(settings, 'MESSAGES_PERSISTENT_MAX_SHOWN', None)
+        if max_shown is not None:
+            # The newest ones, one more than shown tells whether some are left out.
+            messages = messages.reverse()[:max_shown + 1]
+        if getattr(settings, 'MESSAGES_PERSISTENT_LIGHTWEIGHT', False):
+            messages = StoredMessage.from_queryset(messages, self._stored_fields())
+        if max_shown is not None:
+            messages = list(messages)[::-1]
+        if not broadcasts_enabled():
+            return messages
+        broadcasts = list(self._broadcast_queryset(using))
+        if broadcasts:
+            messages = sorted(chain(messages, broadcasts), key=attrgetter('created'))
+        return messages
+
+    async def _aload_messages(self, user):
+        """
+        Async version of ``_load_messages``, for the ``user`` already loaded
+        by ``aget_request_user``: ``request.user`` can't be evaluated here.
+        """
+        using = None
+        if cache.get_cache() is None:
+            using = await routing.aread_database(user.pk)
+        queryset = self._message_queryset(using=using, user=user)
+        max_shown = getattr(settings, 'MESSAGES_PERSISTENT_MAX_SHOWN', None)
+        if max_shown is not None:
+            queryset = queryset.reverse()[:max_shown + 1]
+        if getattr(settings, 'MESSAGES_PERSISTENT_LIGHTWEIGHT', False):
+            messages = [StoredMessage(*row) async for row in
+                        queryset.values_list(*self._stored_fields())]
+        else:
+            messages = [message async for message in queryset]
+        if max_shown is not None:
+            messages.reverse()
+        if not broadcasts_enabled():
+            return messages
+        broadcasts = [broadcast async for broadcast in self._broadcast_queryset(using, user)]
+        if broadcasts:
+            messages = sorted(chain(messages, broadcasts), key=attrgetter('created'))
+        return messages
+
+    def _get_messages(self):
+        """
+        Returns the stored messages of the authenticated request user.
+        """
+        if cache.get_cache() is not None:
+            return cache.get_messages(self.get_user().pk, self._load_messages)
+        return self._load_messages()
+
+    def _limit(self, messages, user=None):
+        """
+        Keeps the newest ``MESSAGES_PERSISTENT_MAX_SHOWN`` messages, counting
+        the unread messages left out in ``hidden_count``.
+        """
+        max_shown = getattr(settings, 'MESSAGES_PERSISTENT_MAX_SHOWN', None)
+        if max_shown is None or len(messages) <= max_shown:
+            return messages
+        # Only the newest messages were loaded, so count the others.
+        broadcasts = sum(1 for message in messages if message.is_broadcast)
+        unread = counters.get_unread_count(user if user is not None else self.get_user())
+        unread += broadcasts
+        self._hidden_count = max(unread - max_shown, len(messages) - max_shown)
+        return messages[len(messages) - max_shown:]
 
     def _get(self, *args, **kwargs):
         """
@@ -150,21 +412,83 @@ class PersistentStorage(BaseStorage):
             is_authenticated = is_authenticated()
         if is_authenticated is not True:
             return [], False
-        return self._message_queryset(), False
+        messages = self._limit(self._get_messages())
+        if self._pending_messages:
+            user = self.get_user()
+            messages = list(messages) + [message for message in self._pending_messages
+                                         if message.user_id == user.pk]
+        return messages, False
+
+    async def aget_messages(self):
+        """
+        Returns the list of stored messages of the request user, like
+        ``_get``, using the async ORM.
+        """
+        user = await aget_request_user(self.request)
+        if not user.is_authenticated:
+            return []
+        messages = await cache.aget_messages(user.pk, lambda: self._aload_messages(user))
+        max_shown = getattr(settings, 'MESSAGES_PERSISTENT_MAX_SHOWN', None)
+        if max_shown is not None and len(messages) > max_shown:
+            messages = await sync_to_async(self._limit)(messages, user)
+        if self._pending_messages:
+            messages = list(messages) + [message for message in self._pending_messages
+                                         if message.user_id == user.pk]
+        return messages
 
     def _store(self, messages, response, *args, **kwargs):
-        #There are alredy saved.
+        #There are alredy saved, except the deferred ones.
+        self.flush()
         return [message for message in messages if not message.level in PERSISTENT_MESSAGE_LEVELS]
 
-    def process_message(self, message, *args, **kwargs):
+    def _defer(self, message):
         """
-        If its level is into persist levels, convert the message to models and save it
+        Keeps ``message`` to be written by ``flush``. When it is added in a
+        transaction, as with ``ATOMIC_REQUESTS``, it is only written if that
+        transaction commits, as it would have been if saved at once.
         """
-        if not message.level in PERSISTENT_MESSAGE_LEVELS:
-            return message
+        self._pending_messages.append(message)
+        if transaction.get_connection().in_atomic_block:
+            message._committed = False
 
-        user = kwargs.get("user") or self.get_user()
+            def committed():
+                message._committed = True
+            transaction.on_commit(committed)
+
+    def flush(self):
+        """
+        Saves the deferred messages in one transaction, keeping the order in
+        which they were added. Those added in a transaction that rolled back
+        are dropped.
+        """
+        pending, self._pending_messages = self._pending_messages, []
+        if not transaction.get_connection().in_atomic_block:
+            # Inside a transaction they are written with it.
+            pending = [message for message in pending if getattr(message, '_committed', True)]
+        if pending:
+            self._save(pending)
+
+    def _save(self, messages):
+        """
+        Writes ``messages``, through the outbox when it is enabled.
+        """
+        routing.stick(message.user_id for message in messages)
+        if outbox.enabled():
+            outbox_ = outbox.get_outbox()
+            transaction.on_commit(lambda: outbox_.put(messages))
+            return
+        save_messages(messages)
+
+    def defers_writes(self):
+        """
+        Whether added messages are kept until the response is stored.
+        """
+        return getattr(settings, 'MESSAGES_PERSISTENT_DEFERRED', False)
 
+    def _build_message(self, message, user, kwargs):
+        """
+        Returns an unsaved model instance for ``message`` sent to ``user``.
+        """
         try:
             anonymous = user.is_anonymous()
         except TypeError:
@@ -179,7 +503,65 @@ class PersistentStorage(BaseStorage):
 
         if "expires" in kwargs:
             message_persistent.expires = kwargs["expires"]
-        message_persistent.save()
+        if "dedup_key" in kwargs:
+            message_persistent.dedup_key = kwargs["dedup_key"]
+        return message_persistent
+
+    def process_message(self, message, *args, **kwargs):
+        """
+        If its level is into persist levels, convert the message to models and save it
+        """
+        if not message.level in PERSISTENT_MESSAGE_LEVELS:
+            return message
+
+        user = kwargs.get("user") or self.get_user()
+        message_persistent = self._build_message(message, user, kwargs)
+        if self.defers_writes():
+            message_persistent._prepare_message()
+            self._defer(message_persistent)
+        elif message_persistent.dedup_key or outbox.enabled():
+            # save() would fail on a duplicate key, the insert skips it.
+            message_persistent._prepare_message()
+            self._save([message_persistent])
+        else:
+            message_persistent.save()
+            retention.enforce([message_persistent.user_id])
+            routing.stick([message_persistent.user_id])
+        return None
+
+    async def aprocess_message(self, message, *args, **kwargs):
+        """
+        Async version of ``process_message``. The message is inserted with
+        ``abulk_create``, so the unread counter and the cache are updated
+        here rather than by the ``post_save`` receivers.
+        """
+        if not message.level in PERSISTENT_MESSAGE_LEVELS:
+            return message
+
+        user = kwargs.get("user") or await aget_request_user(self.request)
+        message_persistent = self._build_message(message, user, kwargs)
+        message_persistent._prepare_message()
+        if self.defers_writes():
+            self._pending_messages.append(message_persistent)
+            return None
+        await routing.astick([user.pk])
+        if outbox.enabled():
+            # Async views seldom run in a transaction, there is no commit to
+            # wait for.
+            await sync_to_async(outbox.get_outbox().put)([message_persistent])
+            return None
+        if message_persistent.dedup_key:
+            if not await sync_to_async(insert_messages)([message_persistent]):
+                return None
+        else:
+            await PersistentMessage.objects.abulk_create([message_persistent])
+            await MessageTag.objects.abulk_create(build_message_tags([message_persistent]))
+        if counters.is_counted(message_persistent):
+            await counters.aincrement([user.pk], expires=message_persistent.expires)
+        await cache.ainvalidate(user.pk)
+        if retention.get_caps():
+            await sync_to_async(retention.enforce)([user.pk])
+        notifications.publish_now([message_persistent])
         return None
 
     def add(self, level, message, extra_tags='', *args, **kwargs):
@@ -202,6 +584,21 @@ class PersistentStorage(BaseStorage):
         if message:
             self._queued_messages.append(message)
 
+    async def aadd(self, level, message, extra_tags='', *args, **kwargs):
+        """
+        Async version of ``add``.
+        """
+        if not message:
+            return
+        level = int(level)
+        if level < self.level:
+            return
+        self.added_new = True
+        message = Message(level, message, extra_tags=extra_tags)
+        message = await self.aprocess_message(message, *args, **kwargs)
+        if message:
+            self._queued_messages.append(message)
+
     def get_user(self):
         if hasattr(self.request, 'user'):
             return self.request.user
@@ -209,11 +606,147 @@ class PersistentStorage(BaseStorage):
             return AnonymousUser()
 
 
+class CachedPersistentStorage(PersistentStorage):
+    """
+    Persistent storage that keeps the active messages of each user in the
+    ``MESSAGES_PERSISTENT_CACHE`` cache, so reading them does not query the
+    database once the entry of the user is warm.
+
+    Added messages are always deferred and written with a single
+    ``bulk_create`` when the response is stored; the entry of the request
+    user is then rebuilt at once. Changes made elsewhere (views, admin,
+    ``bulk_add``) discard the entry, which is reloaded on the next read.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        if cache.get_cache() is None:
+            raise ImproperlyConfigured('CachedPersistentStorage requires the '
+                                       'MESSAGES_PERSISTENT_CACHE setting.')
+        super(CachedPersistentStorage, self).__init__(request, *args, **kwargs)
+
+    def _get_messages(self):
+        return cache.get_state(self.get_user().pk, self._load_messages)
+
+    def defers_writes(self):
+        return True
+
+    def flush(self):
+        # The outbox writes later and discards the entry itself.
+        written = not outbox.enabled() and any(message.user_id == self.get_user().pk
+                                               for message in self._pending_messages)
+        super(CachedPersistentStorage, self).flush()
+        if written:
+            # Runs after the invalidation registered by flush().
+            user_id = self.get_user().pk
+            transaction.on_commit(lambda: cache.set_state(user_id, self._load_messages))
+
+
+class CompactMessageSerializer(object):
+    """
+    Serializes a list of messages as ``[[level, message(, extra_tags)], ...]``
+    JSON, without the per-message marker of Django's ``MessageSerializer``.
+    The level is negative for safe strings; a trailing ``0`` is the
+    ``not_finished`` sentinel of ``CookieStorage``.
+    """
+
+    def dumps(self, obj):
+        items = []
+        for message in obj:
+            if not isinstance(message, Message):
+                items.append(0)
+                continue
+            level = -message.level if isinstance(message.message, SafeData) else message.level
+            item = [level, message.message]
+            if message.extra_tags:
+                item.append(message.extra_tags)
+            items.append(item)
+        return json.dumps(items, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        messages = []
+        for item in json.loads(data.decode('utf-8')):
+            if item == 0:
+                messages.append(CompactCookieStorage.not_finished)
+                continue
+            level, message = item[0], item[1]
+            if level < 0:
+                level, message = -level, mark_safe(message)
+            messages.append(Message(level, message, *item[2:]))
+        return messages
+
+
+class CompactCookieStorage(CookieStorage):
+    """
+    Cookie storage with a compact, compressed and signed encoding, so more
+    messages fit in the cookie before the next backend (usually the
+    session) is used. Drop-in for ``CookieStorage`` in ``MESSAGES_STORAGES``.
+    """
+    cookie_name = 'messages_ext'
+    key_salt = 'messages_extends.storages.CompactCookieStorage'
+
+    def _encode(self, messages, encode_empty=False):
+        if messages or encode_empty:
+            return self.signer.sign_object(messages, serializer=CompactMessageSerializer,
+                                           compress=True)
+
+    def _decode(self, data):
+        if not data:
+            return None
+        try:
+            return self.signer.unsign_object(data, serializer=CompactMessageSerializer)
+        except (signing.BadSignature, binascii.Error, ValueError, TypeError, IndexError):
+            pass
+        self.used = True
+        return None
+
+    def _store(self, messages, response, remove_oldest=True, *args, **kwargs):
+        """
+        Stores as many messages as fit in ``max_cookie_size`` and returns the
+        others. The number that fits is found by bisection, rather than by
+        encoding the messages again after dropping each one.
+        """
+        encoded_data = self._encode(messages)
+        cookie = SimpleCookie()
+
+        def fits(data):
+            return not self.max_cookie_size or\
+                len(cookie.value_encode(data)[1]) <= self.max_cookie_size
+
+        if encoded_data and not fits(encoded_data):
+            def kept(count):
+                return messages[len(messages) - count:] if remove_oldest else messages[:count]
+
+            def encode(count):
+                return self._encode(kept(count) + [self.not_finished], encode_empty=True)
+
+            low, high = 0, len(messages) - 1
+            while low < high:
+                middle = (low + high + 1) // 2
+                if fits(encode(middle)):
+                    low = middle
+                else:
+                    high = middle - 1
+            stored = kept(low)
+            if remove_oldest:
+                unstored_messages = messages[:len(messages) - low]
+            else:
+                unstored_messages = messages[low:]
+            messages[:] = stored
+            encoded_data = encode(low)
+        else:
+            unstored_messages = []
+        self._update_cookie(encoded_data, response)
+        return unstored_messages
+
+
 class StickyStorage(BaseStorage):
     """
     Keep messages that are sticky in memory
     """
 
+    # Nothing is kept between requests, so FallbackStorage skips _get.
+    retrieves_messages = False
+
     def __init__(self, request, *args, **kwargs):
         super(StickyStorage, self).__init__(request, *args, **kwargs)
 
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""tags.py: messages extends
+
+Looks up persistent messages by one of their ``extra_tags`` through the
+indexed ``MessageTag`` table, instead of scanning ``extra_tags``::
+
+    from messages_extends import tags
+
+    tags.tagged('billing', user)     # unread messages of user tagged billing
+    tags.count('billing')            # unread messages tagged billing
+    tags.mark_read('billing')        # retracts them from everyone
+
+The table is kept in sync when messages are saved or added with the
+storages and ``bulk_add``; changes made with ``QuerySet.update()`` are not
+seen. Run the ``rebuild_message_tags`` command after installing.
+"""
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from messages_extends import archive, cache, counters
+from messages_extends.models import Message, MessageTag, split_tags
+
+
+def tagged(tag, user=None, include_read=False):
+    """
+    Returns a queryset of the unexpired messages tagged ``tag``, of ``user``
+    if given, by default only the unread ones.
+    """
+    qs = Message.objects.filter(Q(expires=None) | Q(expires__gt=timezone.now()),
+                                pk__in=MessageTag.objects.filter(tag=tag).values('message'))
+    if user is not None:
+        qs = qs.filter(user_id=getattr(user, 'pk', user))
+    if not include_read:
+        qs = qs.filter(read=False)
+    return qs
+
+
+def count(tag, user=None):
+    """
+    Returns the number of unread messages tagged ``tag``.
+    """
+    return tagged(tag, user).count()
+
+
+def mark_read(tag, user=None, batch_size=1000):
+    """
+    Marks the unread messages tagged ``tag`` as read, ``batch_size`` at a
+    time so no long lock is held. Returns the number of messages marked.
+    """
+    queryset = tagged(tag, user).order_by('pk')
+    marked = 0
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).values_list('pk', 'user_id')[:batch_size])
+        if not rows:
+            return marked
+        last_pk = rows[-1][0]
+        user_ids = set(user_id for pk, user_id in rows)
+        with transaction.atomic():
+            # update() skips auto_now, so set modified for the list ETag.
+            marked += Message.objects.filter(pk__in=[pk for pk, user_id in rows], read=False).\
+                update(read=True, modified=timezone.now())
+            counters.invalidate(user_ids)
+        cache.invalidate_many(user_ids)
+
+
+def _rebuild_batch(pks):
+    # One short transaction per batch, so lookups never see the tags missing.
+    with transaction.atomic():
+        MessageTag.objects.filter(message_id__in=pks).delete()
+        rows = Message.objects.filter(pk__in=pks).exclude(extra_tags='').\
+            values_list('pk', 'extra_tags')
+        return len(MessageTag.objects.bulk_create(
+            [MessageTag(message_id=pk, tag=tag) for pk, extra_tags in rows
+             for tag in split_tags(extra_tags)]))
+
+
+def rebuild_all(batch_size=1000):
+    """
+    Recreates the tags of all messages, ``batch_size`` messages per
+    transaction. Returns the number of tags created.
+    """
+    messages = Message.objects.filter(~Q(extra_tags='') |
+                                      Q(pk__in=MessageTag.objects.values('message')))
+    return sum(_rebuild_batch(pks) for pks in archive.batches(messages, batch_size))
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""messages_extends_tags.py: messages extends"""
+
+from itertools import takewhile
+
+from django import template
+from django.template.loader import render_to_string
+from django.urls import NoReverseMatch, get_script_prefix, get_urlconf, reverse
+from django.utils import translation
+from django.utils.safestring import mark_safe
+
+from messages_extends import cache, counters
+
+register = template.Library()
+
+ALERTS_TEMPLATE = 'messages_extends/includes/alerts_bootstrap_rows.html'
+# Urls are reversed once with this id, which is then replaced by each pk.
+URL_PLACEHOLDER = '2147483647'
+
+
+@register.simple_tag(takes_context=True)
+def unread_messages_count(context, user=None):
+    """
+    Returns the number of unread persistent messages of ``user``, by default
+    the user of the template context::
+
+        {% load messages_extends_tags %}
+        {% unread_messages_count as count %}
+    """
+    if user is None:
+        user = context.get('user')
+        if user is None and context.get('request') is not None:
+            user = getattr(context['request'], 'user', None)
+    if user is None or not user.is_authenticated:
+        return 0
+    return counters.get_unread_count(user)
+
+
+def _url_pattern(name):
+    return reverse(name, args=[URL_PLACEHOLDER])
+
+
+def _render_alerts(messages, template_name, urls, hidden_count=0):
+    alerts = []
+    for message in messages:
+        alert = {'message': message, 'tags': message.tags}
+        if getattr(message, 'pk', None):
+            if message.is_broadcast:
+                name, alert['id_attribute'] = 'broadcast_mark_read', 'broadcast-id'
+            else:
+                name, alert['id_attribute'] = 'message_mark_read', 'message-id'
+            if name not in urls:
+                urls[name] = _url_pattern(name)
+            alert['close_href'] = urls[name].replace(URL_PLACEHOLDER, str(message.pk))
+        alerts.append(alert)
+    return render_to_string(template_name, {'alerts': alerts, 'bulk_href': urls['bulk'],
+                                            'hidden_count': hidden_count})
+
+
+@register.simple_tag(takes_context=True)
+def render_alerts(context, template_name=ALERTS_TEMPLATE):
+    """
+    Renders the messages of the template context like
+    ``alerts_bootstrap.html``, caching the HTML of the persistent messages
+    when ``MESSAGES_PERSISTENT_CACHE`` is set::
+
+        {% load messages_extends_tags %}
+        {% render_alerts %}
+    """
+    messages = context.get('messages')
+    if messages is None:
+        return ''
+    storage, messages = messages, list(messages)
+    hidden_count = getattr(storage, 'hidden_count', 0)
+    try:
+        urls = {'bulk': reverse('message_mark_read_bulk')}
+    except NoReverseMatch:
+        urls = {'bulk': ''}
+    # Stored messages come first, see FallbackStorage._get.
+    persistent = list(takewhile(lambda message: getattr(message, 'pk', None), messages))
+    others = messages[len(persistent):]
+    user = context.get('user')
+    if user is None and context.get('request') is not None:
+        user = getattr(context['request'], 'user', None)
+    variant = '%s|%s|%s|%s' % (template_name, translation.get_language(),
+                               get_script_prefix(), get_urlconf())
+    rendered = cache.get_rendered(getattr(user, 'pk', None), persistent, variant,
+                                  lambda messages: _render_alerts(messages, template_name, urls))
+    if others or hidden_count:
+        rendered += _render_alerts(others, template_name, urls, hidden_count)
+    return mark_safe(rendered)
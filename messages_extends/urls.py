@@ -2,8 +2,13 @@
 """urls.py: messages extends"""
 
 from django.urls import re_path, path
-from messages_extends.views import message_mark_all_read, message_mark_read
+from messages_extends.views import (broadcast_mark_read, message_list, message_mark_all_read,
+                                    message_mark_read, message_mark_read_bulk, message_stream)
 urlpatterns = [
+    path('list/', message_list, name='message_list'),
+    path('stream/', message_stream, name='message_stream'),
     re_path(r'^mark_read/(?P<message_id>\d+)/$', message_mark_read, name='message_mark_read'),
+    path('mark_read/', message_mark_read_bulk, name='message_mark_read_bulk'),
     path('mark_read/all/', message_mark_all_read, name='message_mark_all_read'),
+    re_path(r'^mark_read/broadcast/(?P<broadcast_id>\d+)/$', broadcast_mark_read, name='broadcast_mark_read'),
 ]
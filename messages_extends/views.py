@@ -1,10 +1,47 @@
 # -*- coding: utf-8 -*-
 """views.py: messages extends"""
 
-from messages_extends.models import Message
-from django.http import HttpResponse, HttpResponseRedirect
+import datetime
+import json
+import time
+
+import django
+from asgiref.sync import sync_to_async
+from messages_extends import archive, cache, counters, notifications, routing
+from messages_extends.instrumentation import instrument_view
+from messages_extends.models import (ArchivedMessage, BroadcastReceipt, Message,
+                                     broadcasts_enabled, broadcasts_for, get_tags)
+from messages_extends.storages import aget_request_user
+from django.db.models import Count, Max, Min, Q
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.handlers.asgi import ASGIRequest
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed,
+                         HttpResponseRedirect, JsonResponse, StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.encoding import force_bytes, force_str
+from django.utils.http import http_date, quote_etag, urlsafe_base64_decode, urlsafe_base64_encode
+from django.views.decorators.http import require_GET, require_POST
+
+LIST_FIELDS = {
+    'id': ('pk',),
+    'level': ('level',),
+    'message': ('message',),
+    'extra_tags': ('extra_tags',),
+    'tags': ('level', 'extra_tags', 'read'),
+    'read': ('read',),
+    'created': ('created',),
+    'modified': ('modified',),
+    'expires': ('expires',),
+}
+DEFAULT_LIST_FIELDS = ('id', 'level', 'message', 'tags', 'read', 'created', 'expires')
+DEFAULT_LIST_LIMIT = 20
+MAX_LIST_LIMIT = 100
+STREAM_TIMEOUT = 60
+STREAM_HEARTBEAT = 15
 
 
 def callable_or_bool(fn):
@@ -13,22 +50,449 @@ def callable_or_bool(fn):
     return fn
 
 
+def mark_messages_read(user, **filters):
+    """
+    Marks the unread messages of ``user`` matching ``filters`` as read with
+    a single UPDATE and returns how many were changed.
+
+    Expired messages are left alone: they are not in the unread counter, so
+    it is decremented by exactly the number of messages changed.
+    """
+    now = timezone.now()
+    unexpired = Q(expires=None) | Q(expires__gt=now)
+    queryset = Message.objects.filter(unexpired, user=user, read=False, **filters)
+    pks = None
+    if archive.enabled():
+        # Only the messages marked here are archived.
+        pks = list(queryset.values_list('pk', flat=True))
+        queryset = Message.objects.filter(unexpired, pk__in=pks, read=False)
+    # update() skips auto_now, so set modified for the list ETag.
+    updated = queryset.update(read=True, modified=now)
+    if updated:
+        counters.decrement([user.pk], by=updated)
+        cache.invalidate(user.pk)
+        routing.stick([user.pk])
+        if pks:
+            archive.archive_on_read(pks)
+    return updated
+
+
+@instrument_view
 def message_mark_read(request, message_id):
     if not callable_or_bool(request.user.is_authenticated):
         raise PermissionDenied
-    message = get_object_or_404(Message, user=request.user, pk=message_id)
-    message.read = True
-    message.save()
+    if not mark_messages_read(request.user, pk=message_id) and\
+            not Message.objects.filter(user=request.user, pk=message_id).exists() and\
+            not ArchivedMessage.objects.filter(user=request.user, pk=message_id).exists():
+        raise Http404
     if not request.headers.get('x-requested-with') == 'XMLHttpRequest':
         return HttpResponseRedirect(request.META.get('HTTP_REFERER') or '/')
     else:
         return HttpResponse('')
 
+@instrument_view
+@require_POST
+def message_mark_read_bulk(request):
+    """
+    Marks the messages listed in the ``id`` parameters, and the broadcasts
+    listed in the ``broadcast`` parameters, as read.
+    """
+    if not callable_or_bool(request.user.is_authenticated):
+        raise PermissionDenied
+    try:
+        message_ids = [int(pk) for pk in request.POST.getlist('id')]
+        broadcast_ids = [int(pk) for pk in request.POST.getlist('broadcast')]
+    except ValueError:
+        return HttpResponseBadRequest()
+    if message_ids:
+        mark_messages_read(request.user, pk__in=message_ids)
+    if broadcast_ids:
+        BroadcastReceipt.objects.bulk_create(
+            [BroadcastReceipt(broadcast=broadcast, user=request.user)
+             for broadcast in broadcasts_for(request.user).filter(pk__in=broadcast_ids).only('pk')],
+            ignore_conflicts=True)
+        cache.invalidate(request.user.pk)
+        routing.stick([request.user.pk])
+    if not request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return HttpResponseRedirect(request.META.get('HTTP_REFERER') or '/')
+    else:
+        return HttpResponse('')
+
+async def amark_messages_read(user, **filters):
+    """
+    Async version of ``mark_messages_read``.
+    """
+    now = timezone.now()
+    unexpired = Q(expires=None) | Q(expires__gt=now)
+    queryset = Message.objects.filter(unexpired, user=user, read=False, **filters)
+    pks = None
+    if archive.enabled():
+        pks = [pk async for pk in queryset.values_list('pk', flat=True)]
+        queryset = Message.objects.filter(unexpired, pk__in=pks, read=False)
+    updated = await queryset.aupdate(read=True, modified=now)
+    if updated:
+        await counters.adecrement([user.pk], by=updated)
+        await cache.ainvalidate(user.pk)
+        await routing.astick([user.pk])
+        if pks:
+            await sync_to_async(archive.archive_on_read)(pks)
+    return updated
+
+
+@instrument_view
+async def amessage_mark_read(request, message_id):
+    """
+    Async version of ``message_mark_read`` for ASGI deployments.
+    """
+    user = await aget_request_user(request)
+    if not user.is_authenticated:
+        raise PermissionDenied
+    if not await amark_messages_read(user, pk=message_id):
+        if not await Message.objects.filter(user=user, pk=message_id).aexists() and\
+                not await ArchivedMessage.objects.filter(user=user, pk=message_id).aexists():
+            raise Http404
+    if not request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return HttpResponseRedirect(request.META.get('HTTP_REFERER') or '/')
+    else:
+        return HttpResponse('')
+
+@instrument_view
 def message_mark_all_read(request):
     if not callable_or_bool(request.user.is_authenticated):
         raise PermissionDenied
-    Message.objects.filter(user=request.user).update(read=True)
+    queryset = Message.objects.filter(user=request.user, read=False)
+    pks = []
+    if archive.enabled():
+        pks = list(queryset.values_list('pk', flat=True))
+        queryset = Message.objects.filter(pk__in=pks, read=False)
+    # update() skips auto_now, so set modified for the list ETag.
+    queryset.update(read=True, modified=timezone.now())
+    counters.reset([request.user.pk])
+    if broadcasts_enabled():
+        BroadcastReceipt.objects.bulk_create(
+            [BroadcastReceipt(broadcast=broadcast, user=request.user)
+             for broadcast in broadcasts_for(request.user).only('pk')],
+            ignore_conflicts=True)
+    cache.invalidate(request.user.pk)
+    routing.stick([request.user.pk])
+    if pks:
+        archive.archive_on_read(pks)
+    if not request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return HttpResponseRedirect(request.META.get('HTTP_REFERER') or '/')
+    else:
+        return HttpResponse('')
+
+@instrument_view
+async def amessage_mark_all_read(request):
+    """
+    Async version of ``message_mark_all_read`` for ASGI deployments.
+    """
+    user = await aget_request_user(request)
+    if not user.is_authenticated:
+        raise PermissionDenied
+    queryset = Message.objects.filter(user=user, read=False)
+    pks = []
+    if archive.enabled():
+        pks = [pk async for pk in queryset.values_list('pk', flat=True)]
+        queryset = Message.objects.filter(pk__in=pks, read=False)
+    await queryset.aupdate(read=True, modified=timezone.now())
+    await counters.areset([user.pk])
+    if broadcasts_enabled():
+        await BroadcastReceipt.objects.abulk_create(
+            [BroadcastReceipt(broadcast=broadcast, user=user)
+             async for broadcast in broadcasts_for(user).only('pk')],
+            ignore_conflicts=True)
+    await cache.ainvalidate(user.pk)
+    await routing.astick([user.pk])
+    if pks:
+        await sync_to_async(archive.archive_on_read)(pks)
+    if not request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return HttpResponseRedirect(request.META.get('HTTP_REFERER') or '/')
+    else:
+        return HttpResponse('')
+
+@instrument_view
+def broadcast_mark_read(request, broadcast_id):
+    if not callable_or_bool(request.user.is_authenticated):
+        raise PermissionDenied
+    broadcast = get_object_or_404(broadcasts_for(request.user, include_read=True),
+                                  pk=broadcast_id)
+    BroadcastReceipt.objects.get_or_create(broadcast=broadcast, user=request.user)
+    routing.stick([request.user.pk])
     if not request.headers.get('x-requested-with') == 'XMLHttpRequest':
         return HttpResponseRedirect(request.META.get('HTTP_REFERER') or '/')
     else:
         return HttpResponse('')
+
+
+def encode_cursor(created, pk):
+    return urlsafe_base64_encode(force_bytes('%s,%s' % (created.isoformat(), pk)))
+
+
+def decode_cursor(cursor):
+    """
+    Returns the ``(created, pk)`` of the last message of the previous page.
+    """
+    created, pk = force_str(urlsafe_base64_decode(cursor)).split(',')
+    return datetime.datetime.fromisoformat(created), int(pk)
+
+
+@instrument_view
+@require_GET
+def message_list(request):
+    """
+    Returns the unexpired messages of the user as JSON, newest first.
+
+    Query parameters: ``read`` (``0`` or ``1``), ``level`` (repeatable),
+    ``fields`` (comma separated, see ``LIST_FIELDS``), ``limit`` and the
+    ``cursor`` returned as ``next`` by the previous page. Pages are selected
+    by ``(created, id)`` rather than offsets, and the response carries an
+    ETag and Last-Modified so polling clients get a 304 when nothing changed.
+    """
+    if not callable_or_bool(request.user.is_authenticated):
+        raise PermissionDenied
+    try:
+        fields = request.GET.get('fields')
+        fields = fields.split(',') if fields else DEFAULT_LIST_FIELDS
+        columns = set(column for field in fields for column in LIST_FIELDS[field])
+        limit = min(int(request.GET.get('limit', DEFAULT_LIST_LIMIT)), MAX_LIST_LIMIT)
+        levels = [int(level) for level in request.GET.getlist('level')]
+        cursor = decode_cursor(request.GET['cursor']) if request.GET.get('cursor') else None
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest()
+    if limit < 1:
+        return HttpResponseBadRequest()
+
+    # Archived messages are read, so they are listed unless read=0.
+    models = [Message]
+    if request.GET.get('read') != '0':
+        models.append(ArchivedMessage)
+    using = routing.read_database(request.user.pk)
+    querysets = []
+    for model in models:
+        qs = model.objects.using(using).filter(Q(expires=None) | Q(expires__gt=timezone.now()),
+                                  user=request.user)
+        if request.GET.get('read') in ('0', '1'):
+            qs = qs.filter(read=request.GET['read'] == '1')
+        if levels:
+            qs = qs.filter(level__in=levels)
+        querysets.append(qs)
+
+    def summarize():
+        states = [qs.aggregate(modified=Max('modified'), count=Count('pk'),
+                               valid_until=Min('expires')) for qs in querysets]
+        return {'modified': max([state['modified'] for state in states if state['modified']],
+                                default=None),
+                'count': sum(state['count'] for state in states),
+                'valid_until': min([state['valid_until'] for state in states
+                                    if state['valid_until']], default=None)}
+
+    # With MESSAGES_PERSISTENT_CACHE the aggregate only runs after the
+    # messages of the user changed, not on every poll.
+    state = cache.get_listing(request.user.pk, request.GET.urlencode(), summarize)
+    etag = quote_etag(cache.md5(force_bytes('%s|%s|%s' % (
+        state['modified'], state['count'], request.GET.urlencode()))).hexdigest())
+    last_modified = int(state['modified'].timestamp()) if state['modified'] else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        rows = []
+        for qs in querysets:
+            if cursor is not None:
+                created, pk = cursor
+                qs = qs.filter(Q(created__lt=created) | Q(created=created, pk__lt=pk))
+            rows.extend(qs.order_by('-created', '-pk').
+                        values(*(columns | set(['pk', 'created'])))[:limit + 1])
+        rows.sort(key=lambda row: (row['created'], row['pk']), reverse=True)
+        page = []
+        for row in rows[:limit]:
+            item = {}
+            for field in fields:
+                if field == 'id':
+                    item[field] = row['pk']
+                elif field == 'tags':
+                    item[field] = get_tags(row['level'], row['extra_tags'], row['read'])
+                else:
+                    item[field] = row[field]
+            page.append(item)
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = encode_cursor(rows[limit - 1]['created'], rows[limit - 1]['pk'])
+        response = JsonResponse({'messages': page, 'next': next_cursor})
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def sse_event(event):
+    return 'id: %s\nevent: message\ndata: %s\n\n' % (
+        event['id'], json.dumps(event, cls=DjangoJSONEncoder))
+
+
+def _last_event_id(request):
+    return int(request.headers.get('last-event-id') or request.GET.get('last_id') or 0)
+
+
+def _missed_messages(user, last_id):
+    return Message.objects.filter(Q(expires=None) | Q(expires__gt=timezone.now()),
+                                  user=user, read=False, pk__gt=last_id).order_by('pk')
+
+
+def _stream_timeouts():
+    timeout = getattr(settings, 'MESSAGES_STREAM_TIMEOUT', STREAM_TIMEOUT)
+    return timeout, min(getattr(settings, 'MESSAGES_STREAM_HEARTBEAT', STREAM_HEARTBEAT), timeout)
+
+
+def _stream_response(content):
+    response = StreamingHttpResponse(content, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@instrument_view
+@require_GET
+def message_stream(request):
+    """
+    Pushes the messages created for the user while the request is open, as
+    server-sent events, or with ``?poll=1`` as a JSON long-poll answered on
+    the first message.
+
+    Messages created after the ``Last-Event-ID`` header (or ``last_id``
+    parameter) are replayed first. The stream ends after
+    ``MESSAGES_STREAM_TIMEOUT`` seconds; EventSource clients reconnect by
+    themselves.
+
+    It holds a thread while it waits, so it is for WSGI only; under ASGI
+    ``amessage_stream`` is served instead.
+    """
+    if isinstance(request, ASGIRequest):
+        raise ImproperlyConfigured('message_stream blocks the event loop under ASGI, include '
+                                   'messages_extends.async_urls to serve amessage_stream.')
+    if not callable_or_bool(request.user.is_authenticated):
+        raise PermissionDenied
+    try:
+        last_id = _last_event_id(request)
+    except ValueError:
+        return HttpResponseBadRequest()
+    timeout, heartbeat = _stream_timeouts()
+    bus = notifications.get_bus()
+
+    def replay():
+        if not last_id:
+            return []
+        return [notifications.message_event(message) for message in
+                _missed_messages(request.user, last_id)]
+
+    def events(subscription, missed):
+        # Skips the events of the replayed messages; None is a heartbeat.
+        seen = set(event['id'] for event in missed)
+        for event in missed:
+            yield event
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            event = subscription.get(timeout=min(heartbeat, remaining))
+            if event is None or event['id'] not in seen:
+                yield event
+
+    # Each path subscribes before reading the database, so nothing created
+    # in between is missed, and closes the subscription whatever happens.
+    if request.GET.get('poll') == '1':
+        subscription = bus.subscribe(request.user.pk)
+        try:
+            found = replay()
+            if not found:
+                for event in events(subscription, found):
+                    if event is not None:
+                        found = [event]
+                        break
+        finally:
+            subscription.close()
+        return JsonResponse({'messages': found})
+
+    def stream():
+        # Runs when the server starts sending, so a response that is never
+        # sent holds no subscription.
+        subscription = bus.subscribe(request.user.pk)
+        try:
+            for event in events(subscription, replay()):
+                if event is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield sse_event(event)
+        finally:
+            subscription.close()
+
+    return _stream_response(stream())
+
+
+@instrument_view
+async def amessage_stream(request):
+    """
+    Async version of ``message_stream`` for ASGI deployments, waiting for
+    messages on the event loop. Streaming from an async view needs Django
+    4.2; before it only ``?poll=1`` is served.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    user = await aget_request_user(request)
+    if not user.is_authenticated:
+        raise PermissionDenied
+    try:
+        last_id = _last_event_id(request)
+    except ValueError:
+        return HttpResponseBadRequest()
+    poll = request.GET.get('poll') == '1'
+    if not poll and django.VERSION < (4, 2):
+        return HttpResponse('Streaming needs Django 4.2, use ?poll=1.', status=501)
+    timeout, heartbeat = _stream_timeouts()
+    bus = notifications.get_bus()
+
+    async def replay():
+        if not last_id:
+            return []
+        return [notifications.message_event(message) async for message in
+                _missed_messages(user, last_id)]
+
+    async def events(subscription, missed):
+        seen = set(event['id'] for event in missed)
+        for event in missed:
+            yield event
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            event = await subscription.aget(timeout=min(heartbeat, remaining))
+            if event is None or event['id'] not in seen:
+                yield event
+
+    if poll:
+        subscription = bus.subscribe(user.pk)
+        try:
+            found = await replay()
+            if not found:
+                async for event in events(subscription, found):
+                    if event is not None:
+                        found = [event]
+                        break
+        finally:
+            subscription.close()
+        return JsonResponse({'messages': found})
+
+    async def stream():
+        subscription = bus.subscribe(user.pk)
+        try:
+            async for event in events(subscription, await replay()):
+                if event is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield sse_event(event)
+        finally:
+            subscription.close()
+
+    return _stream_response(stream())
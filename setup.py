@@ -23,6 +23,9 @@ setup(
     packages=[
         'messages_extends',
         'messages_extends.migrations',
+        'messages_extends.management',
+        'messages_extends.management.commands',
+        'messages_extends.templatetags',
     ],
     include_package_data=True,
     package_data={
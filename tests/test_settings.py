@@ -57,7 +57,11 @@ TEMPLATES = [
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-    }
+    },
+    # Not replicated: stands for a replica lagging behind.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+    },
 }
 
 
@@ -1,25 +1,48 @@
 # -*- coding: utf-8 -*-
 """tests.py: Tests for messages-extends"""
 
+import asyncio
 import datetime
-from unittest import mock
+import threading
+import django
+from io import StringIO
+from unittest import mock, skipIf
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate
-from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import AnonymousUser, Group, User
 from django.contrib.messages.storage import default_storage
+from django.contrib.messages.storage.base import Message as DjangoMessage
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, connections, transaction
 from django.db.models.deletion import Collector
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.template.loader import render_to_string
 from django.test.client import RequestFactory
 
-from messages_extends.storages import PersistentStorage
+import messages_extends
+from messages_extends.admin import EstimatedCountPaginator, estimate_count
+from messages_extends import (cache, counters, instrumentation, notifications, outbox, tags,
+                              views)
+from messages_extends.storages import (CachedPersistentStorage, CompactCookieStorage,
+                                       PersistentStorage)
 
 from django.urls import reverse
-from django.test import Client, TestCase
-from django.test.utils import override_settings
+from django.test import Client, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from django.utils.safestring import SafeData, mark_safe
 
-from messages_extends.constants import PERSISTENT_MESSAGE_LEVELS, WARNING_PERSISTENT
-from messages_extends.models import Message
+from messages_extends.constants import INFO_PERSISTENT, PERSISTENT_MESSAGE_LEVELS, WARNING_PERSISTENT
+from messages_extends.exceptions import LevelOfMessageException
+from messages_extends.models import (ArchivedMessage, BroadcastReceipt, Message, MessageTag,
+                                     StoredMessage, UnreadCount, insert_messages)
 
 class MessagesClient(Client):
     """ Baseline Client for Messages Extends.  This is needed to hook messages into the client
@@ -144,3 +167,1322 @@ class MessagesTests(TestCase):
         # User cascade deletes Message
         user.delete()
         self.assertEqual(Message.objects.count(), 0)
+
+    def test_message_queryset_unread_unexpired(self):
+        user = self._get_user()
+        now = timezone.now()
+        Message.objects.create(user=user, level=WARNING_PERSISTENT, message="read", read=True)
+        Message.objects.create(user=user, level=WARNING_PERSISTENT, message="expired",
+                               expires=now - datetime.timedelta(days=1))
+        first = Message.objects.create(user=user, level=WARNING_PERSISTENT, message="first")
+        second = Message.objects.create(user=user, level=WARNING_PERSISTENT, message="second",
+                                        expires=now + datetime.timedelta(days=1))
+        req = RequestFactory().get("/")
+        req.user = user
+        qs = PersistentStorage(req)._message_queryset()
+        self.assertEqual(list(qs), [first, second])
+        self.assertEqual(qs.query.order_by, ('created', 'pk'))
+
+
+@override_settings(MESSAGES_PERSISTENT_CACHE='default')
+class CachedMessagesTests(TestCase):
+    client_class = MessagesClient
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create(username="bob")
+        self.user.set_password('password')
+        self.user.save()
+        self.client.login(username="bob", password='password')
+
+    def _storage(self):
+        req = RequestFactory().get("/")
+        req.user = self.user
+        return PersistentStorage(req)
+
+    def test_get_is_cached(self):
+        messages.add_message(self.client, WARNING_PERSISTENT, "Warning..")
+        self.assertEqual(len(self._storage()._get()[0]), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self._storage()._get()[0]), 1)
+
+    def test_invalidated_on_write(self):
+        messages.add_message(self.client, WARNING_PERSISTENT, "Warning..")
+        self.assertEqual(len(self._storage()._get()[0]), 1)
+        messages.add_message(self.client, WARNING_PERSISTENT, "Another")
+        self.assertEqual(len(self._storage()._get()[0]), 2)
+
+        message = Message.objects.first()
+        self.client.get(reverse('messages:message_mark_read', kwargs={'message_id': message.pk}))
+        self.assertEqual(len(self._storage()._get()[0]), 1)
+
+        self.client.get(reverse('messages:message_mark_all_read'))
+        self.assertEqual(len(self._storage()._get()[0]), 0)
+
+    def test_timeout_follows_expiry(self):
+        expires = timezone.now() + datetime.timedelta(seconds=60)
+        messages.add_message(self.client, WARNING_PERSISTENT, "Warning..", expires=expires)
+        timeout = cache.get_timeout(Message.objects.all())
+        self.assertTrue(0 < timeout <= 60)
+
+
+class BulkAddTests(TestCase):
+
+    def test_bulk_add_queryset(self):
+        users = [User.objects.create(username="user%s" % i) for i in range(5)]
+        with CaptureQueriesContext(connection) as queries:
+            created = messages_extends.bulk_add(User.objects.all(), WARNING_PERSISTENT,
+                                                "Announcement", batch_size=3)
+        self.assertEqual(created, 5)
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)
+        for user in users:
+            result = Message.objects.get(user=user)
+            self.assertEqual(result.message, "Announcement")
+            self.assertFalse(result.read)
+
+    def test_bulk_add_ids_and_users(self):
+        user, other = User.objects.create(username="bob"), User.objects.create(username="john")
+        expires = timezone.now() + datetime.timedelta(days=1)
+        created = messages_extends.bulk_add([user, other.pk], WARNING_PERSISTENT, "Hi",
+                                            extra_tags="billing", expires=expires)
+        self.assertEqual(created, 2)
+        self.assertEqual(Message.objects.filter(extra_tags="billing", expires=expires).count(), 2)
+
+    def test_bulk_add_rejects_non_persistent_levels(self):
+        with self.assertRaises(LevelOfMessageException):
+            messages_extends.bulk_add([], messages.WARNING, "Hi")
+
+
+@override_settings(MESSAGES_PERSISTENT_DEFERRED=True)
+class DeferredMessagesTests(TestCase):
+
+    def _request(self):
+        req = RequestFactory().get("/")
+        req.user = User.objects.create(username="bob")
+        req.session = {}
+        return req
+
+    def test_messages_are_saved_when_stored(self):
+        storage = default_storage(self._request())
+        expires = timezone.now() + datetime.timedelta(days=1)
+        with self.assertNumQueries(0):
+            for i in range(5):
+                storage.add(WARNING_PERSISTENT, "Warning %s" % i, expires=expires if i == 2 else None)
+        self.assertEqual(Message.objects.count(), 0)
+        # Still shown in the request that added them.
+        self.assertEqual(len(list(storage)), 5)
+
+        storage.update(HttpResponse())
+        self.assertEqual([m.message for m in Message.objects.order_by('created', 'pk')],
+                         ["Warning %s" % i for i in range(5)])
+        self.assertEqual(Message.objects.get(message="Warning 2").expires, expires)
+
+    def test_messages_are_saved_without_other_messages(self):
+        storage = default_storage(self._request())
+        storage.add(WARNING_PERSISTENT, "Warning")
+        storage.update(HttpResponse())
+        self.assertEqual(Message.objects.count(), 1)
+
+
+@override_settings(MESSAGES_PERSISTENT_DEFERRED=True)
+class DeferredMessagesTransactionTests(TransactionTestCase):
+
+    def test_rolled_back_messages_are_dropped(self):
+        req = RequestFactory().get("/")
+        req.user = User.objects.create(username="bob")
+        req.session = {}
+        storage = default_storage(req)
+        # As with ATOMIC_REQUESTS, the response is stored after the view's
+        # transaction ended.
+        with self.assertRaises(ValueError), transaction.atomic():
+            storage.add(WARNING_PERSISTENT, "Rolled back")
+            raise ValueError
+        with transaction.atomic():
+            storage.add(WARNING_PERSISTENT, "Committed")
+        storage.add(WARNING_PERSISTENT, "Autocommit")
+        storage.update(HttpResponse(status=500))
+        self.assertEqual(list(Message.objects.order_by('pk').values_list('message', flat=True)),
+                         ["Committed", "Autocommit"])
+
+
+class FallbackStorageTests(TestCase):
+
+    def _request(self, user=None):
+        req = RequestFactory().get("/")
+        req.user = user or AnonymousUser()
+        req.session = {}
+        return req
+
+    def test_backends_are_lazy(self):
+        storage = default_storage(self._request())
+        self.assertEqual(storage._storage_instances, {})
+        storage.add(messages.INFO, "Hello")
+        # Only the backend that processes messages has been created.
+        self.assertEqual([type(s).__name__ for s in storage._storage_instances.values()],
+                         ['PersistentStorage'])
+
+    def test_anonymous_get_skips_database(self):
+        storage = default_storage(self._request())
+        with self.assertNumQueries(0):
+            self.assertEqual(list(storage), [])
+        names = [type(s).__name__ for s in storage._storage_instances.values()]
+        self.assertNotIn('StickyStorage', names)
+        # No messages cookie, so the session is never read.
+        self.assertNotIn('SessionStorage', names)
+
+
+class UnreadCountTests(TestCase):
+    client_class = MessagesClient
+
+    def setUp(self):
+        self.user = User.objects.create(username="bob")
+        self.user.set_password('password')
+        self.user.save()
+        self.client.login(username="bob", password='password')
+
+    def test_counter_follows_writes(self):
+        self.assertEqual(counters.get_unread_count(self.user), 0)
+        messages.add_message(self.client, WARNING_PERSISTENT, "One")
+        messages.add_message(self.client, WARNING_PERSISTENT, "Two")
+        messages_extends.bulk_add([self.user], WARNING_PERSISTENT, "Three")
+        with self.assertNumQueries(1):
+            self.assertEqual(counters.get_unread_count(self.user), 3)
+
+        message = Message.objects.get(message="One")
+        self.client.get(reverse('messages:message_mark_read', kwargs={'message_id': message.pk}))
+        self.assertEqual(UnreadCount.objects.get(user=self.user).count, 2)
+
+        Message.objects.get(message="Two").delete()
+        self.assertEqual(UnreadCount.objects.get(user=self.user).count, 1)
+
+        self.client.get(reverse('messages:message_mark_all_read'))
+        self.assertEqual(UnreadCount.objects.get(user=self.user).count, 0)
+
+    def test_counter_is_rebuilt_after_expiry(self):
+        self.assertEqual(counters.get_unread_count(self.user), 0)
+        expires = timezone.now() + datetime.timedelta(days=1)
+        messages.add_message(self.client, WARNING_PERSISTENT, "Expiring", expires=expires)
+        messages.add_message(self.client, WARNING_PERSISTENT, "Staying")
+        self.assertEqual(counters.get_unread_count(self.user), 2)
+        self.assertEqual(UnreadCount.objects.get(user=self.user).valid_until, expires)
+
+        Message.objects.filter(message="Expiring").update(
+            expires=timezone.now() - datetime.timedelta(seconds=1))
+        UnreadCount.objects.update(valid_until=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(counters.get_unread_count(self.user), 1)
+
+    def test_template_tag(self):
+        messages.add_message(self.client, WARNING_PERSISTENT, "One")
+        rendered = Template("{% load messages_extends_tags %}{% unread_messages_count %}").\
+            render(Context({'user': self.user}))
+        self.assertEqual(rendered, "1")
+
+    def test_rebuild_command(self):
+        other = User.objects.create(username="john")
+        messages_extends.bulk_add([self.user, other], WARNING_PERSISTENT, "Hi")
+        Message.objects.create(user=other, level=WARNING_PERSISTENT, message="Read", read=True)
+        UnreadCount.objects.update(count=42)
+        out = StringIO()
+        call_command('rebuild_message_counters', stdout=out)
+        self.assertIn('Rebuilt 2', out.getvalue())
+        self.assertEqual(sorted(UnreadCount.objects.values_list('count', flat=True)), [1, 1])
+
+    def test_rebuild_all_batches(self):
+        users = [User.objects.create(username="user%d" % i) for i in range(3)]
+        messages_extends.bulk_add(users, WARNING_PERSISTENT, "Hi")
+        UnreadCount.objects.update(count=42)
+        UnreadCount.objects.create(user=self.user, count=5)
+        self.assertEqual(counters.rebuild_all(batch_size=1), 3)
+        self.assertEqual(list(UnreadCount.objects.values_list('user', 'count')),
+                         [(user.pk, 1) for user in users])
+
+
+class PurgeMessagesTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username="bob")
+        now = timezone.now()
+        old = now - datetime.timedelta(days=40)
+        self.unread = Message.objects.create(user=user, level=WARNING_PERSISTENT, message="unread")
+        Message.objects.create(user=user, level=WARNING_PERSISTENT, message="expired",
+                               expires=now - datetime.timedelta(seconds=1))
+        Message.objects.create(user=user, level=WARNING_PERSISTENT, message="recent read", read=True)
+        for i in range(3):
+            message = Message.objects.create(user=user, level=WARNING_PERSISTENT,
+                                             message="old read", read=True)
+            Message.objects.filter(pk=message.pk).update(created=old)
+
+    def test_purge_expired(self):
+        call_command('purge_messages', stdout=StringIO())
+        self.assertFalse(Message.objects.filter(message="expired").exists())
+        self.assertEqual(Message.objects.count(), 5)
+
+    def test_purge_old_read_in_batches(self):
+        out = StringIO()
+        call_command('purge_messages', days=30, batch_size=2, verbosity=2, stdout=out)
+        self.assertEqual(sorted(Message.objects.values_list('message', flat=True)),
+                         ["recent read", "unread"])
+        self.assertIn('2 messages so far.', out.getvalue())
+        self.assertIn('Deleted 4 messages.', out.getvalue())
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('purge_messages', days=30, dry_run=True, stdout=out)
+        self.assertIn('4 messages would be deleted.', out.getvalue())
+        self.assertEqual(Message.objects.count(), 6)
+
+
+@override_settings(MESSAGES_BROADCASTS=True)
+class BroadcastTests(TestCase):
+    client_class = MessagesClient
+
+    def setUp(self):
+        self.user = User.objects.create(username="bob")
+        self.user.set_password('password')
+        self.user.save()
+        self.other = User.objects.create(username="john")
+        self.client.login(username="bob", password='password')
+
+    def _messages(self, user=None):
+        req = RequestFactory().get("/")
+        req.user = user or self.user
+        return [str(message) for message in PersistentStorage(req)._get()[0]]
+
+    def test_targets(self):
+        group = Group.objects.create(name="staff")
+        self.other.groups.add(group)
+        messages_extends.broadcast(WARNING_PERSISTENT, "Everybody")
+        messages_extends.broadcast(WARNING_PERSISTENT, "Staff", group=group)
+        messages_extends.broadcast(WARNING_PERSISTENT, "Bob", users=User.objects.filter(pk=self.user.pk))
+        messages_extends.broadcast(WARNING_PERSISTENT, "Expired",
+                                   expires=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(self._messages(), ["Everybody", "Bob"])
+        self.assertEqual(self._messages(self.other), ["Everybody", "Staff"])
+
+    def test_merged_with_personal_messages(self):
+        messages.add_message(self.client, WARNING_PERSISTENT, "Personal")
+        messages_extends.broadcast(WARNING_PERSISTENT, "Everybody")
+        self.assertEqual(self._messages(), ["Personal", "Everybody"])
+
+    def test_mark_read(self):
+        broadcast = messages_extends.broadcast(WARNING_PERSISTENT, "Everybody")
+        url = reverse('messages:broadcast_mark_read', kwargs={'broadcast_id': broadcast.pk})
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(self._messages(), [])
+        self.assertEqual(self._messages(self.other), ["Everybody"])
+        self.assertEqual(BroadcastReceipt.objects.count(), 1)
+
+    def test_mark_read_not_targeted(self):
+        broadcast = messages_extends.broadcast(WARNING_PERSISTENT, "John", users=[self.other])
+        url = reverse('messages:broadcast_mark_read', kwargs={'broadcast_id': broadcast.pk})
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_mark_all_read(self):
+        messages.add_message(self.client, WARNING_PERSISTENT, "Personal")
+        messages_extends.broadcast(WARNING_PERSISTENT, "Everybody")
+        self.client.get(reverse('messages:message_mark_all_read'))
+        self.assertEqual(self._messages(), [])
+
+    @override_settings(MESSAGES_PERSISTENT_CACHE='default')
+    def test_cache_invalidated_by_new_broadcast(self):
+        caches['default'].clear()
+        self.assertEqual(self._messages(), [])
+        messages_extends.broadcast(WARNING_PERSISTENT, "Everybody")
+        self.assertEqual(self._messages(), ["Everybody"])
+
+
+class MessageListTests(TestCase):
+    client_class = MessagesClient
+
+    def setUp(self):
+        self.user = User.objects.create(username="bob")
+        self.user.set_password('password')
+        self.user.save()
+        self.client.login(username="bob", password='password')
+        self.url = reverse('messages:message_list')
+
+    def _add(self, count, **kwargs):
+        for i in range(count):
+            Message.objects.create(user=self.user, level=WARNING_PERSISTENT,
+                                   message="Message %s" % i, **kwargs)
+
+    def test_keyset_pages(self):
+        self._add(5)
+        Message.objects.create(user=User.objects.create(username="john"),
+                               level=WARNING_PERSISTENT, message="Other")
+        seen = []
+        data = self.client.get(self.url, {'limit': 2}).json()
+        while True:
+            seen.extend(item['message'] for item in data['messages'])
+            if not data['next']:
+                break
+            data = self.client.get(self.url, {'limit': 2, 'cursor': data['next']}).json()
+        self.assertEqual(seen, ["Message %s" % i for i in reversed(range(5))])
+
+    def test_filters_and_fields(self):
+        self._add(2)
+        self._add(1, read=True)
+        self._add(1, expires=timezone.now() - datetime.timedelta(seconds=1))
+        data = self.client.get(self.url, {'read': '0', 'fields': 'id,tags'}).json()
+        self.assertEqual(len(data['messages']), 2)
+        self.assertEqual(set(data['messages'][0]), {'id', 'tags'})
+        self.assertEqual(data['messages'][0]['tags'], 'warning persistent unread')
+        data = self.client.get(self.url, {'level': messages.WARNING}).json()
+        self.assertEqual(data['messages'], [])
+        self.assertEqual(self.client.get(self.url, {'fields': 'user'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'cursor': 'nope'}).status_code, 400)
+
+    def test_conditional_get(self):
+        self._add(1)
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.client.get(reverse('messages:message_mark_all_read'))
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    @override_settings(MESSAGES_PERSISTENT_CACHE='default')
+    def test_cached_etag(self):
+        self._add(1)
+        etag = self.client.get(self.url)['ETag']
+        with self.assertNumQueries(2):  # The session and the user.
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self._add(1)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_requires_login(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+
+class MarkReadTests(TestCase):
+    client_class = MessagesClient
+
+    def setUp(self):
+        self.user = User.objects.create(username="bob")
+        self.user.set_password('password')
+        self.user.save()
+        self.client.login(username="bob", password='password')
+        self.messages = [Message.objects.create(user=self.user, level=WARNING_PERSISTENT,
+                                                message="Message %s" % i) for i in range(3)]
+
+    def test_single_uses_one_update(self):
+        url = reverse('messages:message_mark_read', kwargs={'message_id': self.messages[0].pk})
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertEqual(len([q for q in queries.captured_queries
+                              if 'messages_extends_message' in q['sql']]), 1)
+        self.assertTrue(Message.objects.get(pk=self.messages[0].pk).read)
+        # Already read messages are not an error.
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+    def test_single_not_found(self):
+        url = reverse('messages:message_mark_read', kwargs={'message_id': 999})
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_expired_not_counted(self):
+        expired = Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Old",
+                                         expires=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertEqual(counters.get_unread_count(self.user), 3)
+        self.client.post(reverse('messages:message_mark_read_bulk'),
+                         {'id': [expired.pk, self.messages[0].pk]})
+        self.assertEqual(counters.get_unread_count(self.user), 2)
+        url = reverse('messages:message_mark_read', kwargs={'message_id': expired.pk})
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.assertEqual(counters.get_unread_count(self.user), 2)
+
+    def test_bulk(self):
+        other = Message.objects.create(user=User.objects.create(username="john"),
+                                       level=WARNING_PERSISTENT, message="Other")
+        broadcast = messages_extends.broadcast(WARNING_PERSISTENT, "Everybody")
+        self.assertEqual(counters.get_unread_count(self.user), 3)
+        response = self.client.post(reverse('messages:message_mark_read_bulk'),
+                                    {'id': [self.messages[0].pk, self.messages[1].pk, other.pk],
+                                     'broadcast': [broadcast.pk]},
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(Message.objects.filter(read=False).order_by('pk')),
+                         [self.messages[2], other])
+        self.assertTrue(BroadcastReceipt.objects.filter(user=self.user, broadcast=broadcast).exists())
+        self.assertEqual(counters.get_unread_count(self.user), 1)
+
+    def test_bulk_requires_post(self):
+        self.assertEqual(self.client.get(reverse('messages:message_mark_read_bulk')).status_code, 405)
+
+
+@skipIf(django.VERSION < (4, 1), "The async ORM requires Django 4.1")
+class AsyncTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="bob")
+        self.message = Message.objects.create(user=self.user, level=WARNING_PERSISTENT,
+                                              message="Warning..")
+        self.async_client.force_login(self.user)
+
+    async def test_mark_read(self):
+        url = reverse('async_messages:message_mark_read', kwargs={'message_id': self.message.pk})
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue((await Message.objects.aget(pk=self.message.pk)).read)
+        response = await self.async_client.get(
+            reverse('async_messages:message_mark_read', kwargs={'message_id': 999}))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_mark_all_read(self):
+        response = await self.async_client.get(reverse('async_messages:message_mark_all_read'))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(await Message.objects.filter(read=False).aexists())
+
+    async def test_storage(self):
+        req = RequestFactory().get("/")
+        req.user = self.user
+        storage = PersistentStorage(req)
+        await storage.aadd(WARNING_PERSISTENT, "Async")
+        self.assertEqual(await Message.objects.acount(), 2)
+        self.assertEqual([str(m) for m in await storage.aget_messages()], ["Warning..", "Async"])
+
+    async def test_storage_with_authentication_middleware(self):
+        # request.user is lazy and, on Django 5.0+, not loaded by auser().
+        request = RequestFactory().get("/")
+        request.session = self.async_client.session
+        AuthenticationMiddleware(lambda request: None).process_request(request)
+        storage = PersistentStorage(request)
+        self.assertEqual([str(m) for m in await storage.aget_messages()], ["Warning.."])
+
+    @override_settings(MESSAGES_STREAM_TIMEOUT=5)
+    async def test_stream_poll(self):
+        bus = notifications.get_bus()
+        request = asyncio.ensure_future(
+            self.async_client.get(reverse('async_messages:message_stream'), {'poll': '1'}))
+        while not bus.has_subscribers(self.user.pk):
+            await asyncio.sleep(0.01)
+        notifications.publish_now([self.message])
+        response = await request
+        self.assertEqual([event['id'] for event in response.json()['messages']],
+                         [self.message.pk])
+        self.assertFalse(bus.has_subscribers(self.user.pk))
+
+    @skipIf(django.VERSION < (4, 2), "Async streaming responses require Django 4.2")
+    @override_settings(MESSAGES_STREAM_TIMEOUT=0.5, MESSAGES_STREAM_HEARTBEAT=0.1)
+    async def test_stream(self):
+        response = await self.async_client.get(reverse('async_messages:message_stream'))
+        chunks = response.streaming_content.__aiter__()
+        self.assertEqual(await chunks.__anext__(), b': keepalive\n\n')
+        notifications.publish_now([self.message])
+        self.assertIn(b'id: %d\nevent: message\n' % self.message.pk, await chunks.__anext__())
+        async for chunk in chunks:
+            pass
+        self.assertFalse(notifications.get_bus().has_subscribers(self.user.pk))
+
+    async def test_sync_stream_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            await self.async_client.get(reverse('messages:message_stream'))
+
+    async def test_anonymous_storage(self):
+        req = RequestFactory().get("/")
+        req.user = AnonymousUser()
+        self.assertEqual(await PersistentStorage(req).aget_messages(), [])
+
+
+class NotificationTests(TestCase):
+    client_class = MessagesClient
+
+    def setUp(self):
+        self.user = User.objects.create(username="bob")
+        self.user.set_password('password')
+        self.user.save()
+        self.client.login(username="bob", password='password')
+
+    def test_in_process_bus(self):
+        bus = notifications.InProcessBus()
+        subscription = bus.subscribe(1)
+        bus.publish(1, {'id': 1})
+        bus.publish(2, {'id': 2})
+        self.assertEqual(subscription.get(timeout=0), {'id': 1})
+        self.assertIsNone(subscription.get(timeout=0))
+        subscription.close()
+        self.assertFalse(bus.has_subscribers(1))
+
+    def test_created_messages_are_published(self):
+        subscription = notifications.get_bus().subscribe(self.user.pk)
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                messages.add_message(self.client, WARNING_PERSISTENT, "Single")
+                messages_extends.bulk_add([self.user], WARNING_PERSISTENT, "Bulk")
+            self.assertEqual(subscription.get(timeout=0)['message'], "Single")
+            self.assertEqual(subscription.get(timeout=0)['message'], "Bulk")
+        finally:
+            subscription.close()
+
+    @override_settings(MESSAGES_STREAM_TIMEOUT=0.5, MESSAGES_STREAM_HEARTBEAT=0.1)
+    def test_stream(self):
+        response = self.client.get(reverse('messages:message_stream'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        # Nothing is subscribed until the response is sent.
+        self.assertFalse(notifications.get_bus().has_subscribers(self.user.pk))
+        chunks = iter(response.streaming_content)
+        self.assertEqual(next(chunks), b': keepalive\n\n')
+        with self.captureOnCommitCallbacks(execute=True):
+            message = Message.objects.create(user=self.user, level=WARNING_PERSISTENT,
+                                             message="Pushed")
+        content = b''.join(chunks).decode()
+        self.assertIn('id: %s\nevent: message\n' % message.pk, content)
+        self.assertIn('"message": "Pushed"', content)
+        self.assertFalse(notifications.get_bus().has_subscribers(self.user.pk))
+
+    def test_stream_closed_on_error(self):
+        url = reverse('messages:message_stream')
+        with mock.patch('messages_extends.notifications.message_event', side_effect=ValueError):
+            seen = Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Seen")
+            Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Missed")
+            with self.assertRaises(ValueError):
+                self.client.get(url, {'poll': '1', 'last_id': seen.pk})
+            response = self.client.get(url, {'last_id': seen.pk})
+            with self.assertRaises(ValueError):
+                list(response.streaming_content)
+        self.assertFalse(notifications.get_bus().has_subscribers(self.user.pk))
+
+    @override_settings(MESSAGES_STREAM_TIMEOUT=0.2)
+    def test_long_poll_replays_missed_messages(self):
+        first = Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="First")
+        Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Second")
+        data = self.client.get(reverse('messages:message_stream'),
+                               {'poll': '1', 'last_id': first.pk}).json()
+        self.assertEqual([event['message'] for event in data['messages']], ["Second"])
+        data = self.client.get(reverse('messages:message_stream'), {'poll': '1'}).json()
+        self.assertEqual(data['messages'], [])
+
+
+class InstrumentationTests(TestCase):
+    client_class = MessagesClient
+
+    def setUp(self):
+        self.user = User.objects.create(username="bob")
+        self.user.set_password('password')
+        self.user.save()
+        self.client.login(username="bob", password='password')
+        self.metrics = []
+
+    def record(self, **metrics):
+        self.metrics.append(metrics)
+
+    def _request(self):
+        req = RequestFactory().get("/")
+        req.user = self.user
+        req.session = {}
+        return req
+
+    def test_signal(self):
+        def receiver(sender, **kwargs):
+            self.record(**kwargs)
+        instrumentation.operation_finished.connect(receiver)
+        try:
+            storage = default_storage(self._request())
+            storage.add(WARNING_PERSISTENT, "Hello")
+            list(storage)
+        finally:
+            instrumentation.operation_finished.disconnect(receiver)
+        self.assertEqual([(m['operation'], m['backend']) for m in self.metrics],
+                         [('process_message', PersistentStorage), ('add', None),
+                          ('get', PersistentStorage), ('get', CookieStorage)])
+        process, add, get = self.metrics[:3]
+        self.assertGreaterEqual(process['queries'], 1)
+        self.assertEqual(get['queries'], 1)
+        self.assertEqual(get['messages'], 1)
+        self.assertGreaterEqual(add['duration'], process['duration'])
+
+    def test_callback(self):
+        Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Hello")
+        with override_settings(MESSAGES_METRICS_CALLBACK=self.record):
+            self.client.get(reverse('messages:message_mark_all_read'))
+        self.assertEqual([m['operation'] for m in self.metrics], ['message_mark_all_read'])
+        # The user is loaded inside the view, then one query per table.
+        self.assertEqual(self.metrics[0]['queries'], 4)
+
+    def test_disabled(self):
+        with mock.patch('messages_extends.instrumentation.Measurement.__call__') as counter:
+            storage = default_storage(self._request())
+            storage.add(WARNING_PERSISTENT, "Hello")
+            list(storage)
+        self.assertFalse(counter.called)
+
+    @override_settings(MIDDLEWARE=['messages_extends.middleware.ServerTimingMiddleware']
+                       + settings.MIDDLEWARE)
+    def test_server_timing(self):
+        Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Hello")
+        response = self.client.get(reverse('messages:message_mark_all_read'))
+        self.assertRegex(response['Server-Timing'],
+                         r'^messages-message_mark_all_read;dur=[\d.]+;desc="4 queries"$')
+
+
+@override_settings(MESSAGES_PERSISTENT_CACHE='default')
+class RenderAlertsTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create(username="bob")
+        self.message = Message.objects.create(user=self.user, level=WARNING_PERSISTENT,
+                                              message="Stored")
+        messages_extends.broadcast(WARNING_PERSISTENT, "Everybody")
+
+    def _render(self, template):
+        req = RequestFactory().get("/")
+        req.user = self.user
+        req.session = {}
+        storage = default_storage(req)
+        storage.add(messages.INFO, "Flash")
+        return ' '.join(Template(template).render(Context({'messages': storage})).split())
+
+    @override_settings(MESSAGES_BROADCASTS=True)
+    def test_same_markup_as_include(self):
+        rendered = self._render('{% load messages_extends_tags %}{% render_alerts %}')
+        self.assertEqual(rendered, self._render(
+            '{% include "messages_extends/includes/alerts_bootstrap.html" %}'))
+        self.assertIn('message-id="%s"' % self.message.pk, rendered)
+        self.assertIn('broadcast-id=', rendered)
+        self.assertIn('Flash', rendered)
+
+    def test_persistent_messages_are_cached(self):
+        template = '{% load messages_extends_tags %}{% render_alerts %}'
+        with mock.patch('messages_extends.templatetags.messages_extends_tags.render_to_string',
+                        wraps=render_to_string) as render:
+            first = self._render(template)
+            self.assertEqual(render.call_count, 2)
+            self.assertEqual(self._render(template), first)
+            # Only the non-persistent message is rendered again.
+            self.assertEqual(render.call_count, 3)
+
+            views.mark_messages_read(self.user, pk=self.message.pk)
+            self.assertNotIn('Stored', self._render(template))
+            self.assertEqual(render.call_count, 5)
+
+
+@override_settings(MESSAGES_PERSISTENT_CACHE='default')
+class CachedPersistentStorageTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create(username="bob")
+
+    def _storage(self):
+        req = RequestFactory().get("/")
+        req.user = self.user
+        return CachedPersistentStorage(req)
+
+    def test_write_behind(self):
+        storage = self._storage()
+        with self.assertNumQueries(0):
+            storage.add(WARNING_PERSISTENT, "Deferred")
+        self.assertFalse(Message.objects.exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            storage.update(HttpResponse())
+        self.assertEqual(Message.objects.get().message, "Deferred")
+        self.assertEqual(counters.get_unread_count(self.user), 1)
+        # The entry was rebuilt after the write.
+        with self.assertNumQueries(0):
+            self.assertEqual([m.message for m in self._storage()._get()[0]], ["Deferred"])
+
+    def test_reads_are_served_from_cache(self):
+        Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Stored")
+        self.assertEqual(len(self._storage()._get()[0]), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self._storage()._get()[0]), 1)
+
+        views.mark_messages_read(self.user)
+        self.assertEqual(self._storage()._get()[0], [])
+
+    def test_expired_messages_are_skipped(self):
+        message = Message.objects.create(user=self.user, level=WARNING_PERSISTENT,
+                                         message="Soon expired",
+                                         expires=timezone.now() + datetime.timedelta(minutes=1))
+        self.assertEqual(len(self._storage()._get()[0]), 1)
+        with mock.patch('django.utils.timezone.now',
+                        return_value=message.expires + datetime.timedelta(seconds=1)):
+            with self.assertNumQueries(0):
+                self.assertEqual(self._storage()._get()[0], [])
+
+    def test_reconcile(self):
+        message = Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Stored")
+        self.assertEqual(len(self._storage()._get()[0]), 1)
+        # Updates of querysets bypass the signals, so the entry is stale.
+        Message.objects.filter(pk=message.pk).update(message="Changed")
+        self.assertEqual(self._storage()._get()[0][0].message, "Stored")
+        out = StringIO()
+        call_command('reconcile_message_cache', stdout=out)
+        self.assertIn('1 users', out.getvalue())
+        with self.assertNumQueries(0):
+            self.assertEqual(self._storage()._get()[0][0].message, "Changed")
+
+    @override_settings(MESSAGES_PERSISTENT_CACHE=None)
+    def test_requires_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self._storage()
+
+
+@override_settings(MESSAGES_PERSISTENT_LIGHTWEIGHT=True)
+class LightweightMessagesTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create(username="bob")
+        self.message = Message.objects.create(user=self.user, level=WARNING_PERSISTENT,
+                                              message="Stored", extra_tags="extra")
+
+    def _storage(self):
+        req = RequestFactory().get("/")
+        req.user = self.user
+        return PersistentStorage(req)
+
+    def test_stored_messages(self):
+        stored, = self._storage()._get()[0]
+        self.assertIsInstance(stored, StoredMessage)
+        self.assertEqual((stored.pk, stored.id, str(stored), stored.tags),
+                         (self.message.pk, self.message.pk, "Stored", self.message.tags))
+        self.assertEqual(stored, self.message)
+        self.assertEqual(self.message, stored)
+        self.assertFalse(hasattr(stored, '__dict__'))
+
+    def test_same_markup(self):
+        template = Template('{% include "messages_extends/includes/alerts_bootstrap.html" %}')
+        lightweight = template.render(Context({'messages': self._storage()}))
+        with self.settings(MESSAGES_PERSISTENT_LIGHTWEIGHT=False):
+            full = template.render(Context({'messages': self._storage()}))
+        self.assertEqual(lightweight, full)
+        self.assertIn('message-id="%s"' % self.message.pk, lightweight)
+
+    @override_settings(MESSAGES_BROADCASTS=False)
+    def test_needed_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            stored, = self._storage()._get()[0]
+            select = queries[0]['sql'].split(' FROM ')[0]
+        for column in ('"id"', '"level"', '"message"', '"extra_tags"'):
+            self.assertIn(column, select)
+        for column in ('"user_id"', '"read"', '"created"', '"modified"', '"expires"'):
+            self.assertNotIn(column, select)
+        self.assertIsNone(stored.expires)
+        self.assertEqual(stored.tags, self.message.tags)
+
+    @override_settings(MESSAGES_PERSISTENT_CACHE='default')
+    def test_cached(self):
+        self._storage()._get()
+        with self.assertNumQueries(0):
+            stored, = self._storage()._get()[0]
+        self.assertIsInstance(stored, StoredMessage)
+        self.assertEqual(stored.pk, self.message.pk)
+        self.assertEqual(stored.modified, self.message.modified)
+
+
+class RetentionTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="bob")
+
+    def _request(self):
+        req = RequestFactory().get("/")
+        req.user = self.user
+        req.session = {}
+        return req
+
+    def _add(self, count, level=WARNING_PERSISTENT):
+        storage = PersistentStorage(self._request())
+        for i in range(count):
+            storage.add(level, "Message %s" % i)
+
+    def _unread(self):
+        return list(Message.objects.filter(read=False).order_by('pk').
+                    values_list('message', flat=True))
+
+    @override_settings(MESSAGES_PERSISTENT_MAX_UNREAD=3)
+    def test_cap(self):
+        self._add(5)
+        self.assertEqual(self._unread(), ["Message 2", "Message 3", "Message 4"])
+        self.assertEqual(Message.objects.count(), 5)
+        self.assertEqual(counters.get_unread_count(self.user), 3)
+
+    @override_settings(MESSAGES_PERSISTENT_MAX_UNREAD={WARNING_PERSISTENT: 1, None: 3})
+    def test_cap_per_level(self):
+        self._add(2, level=INFO_PERSISTENT)
+        self._add(2)
+        self.assertEqual(self._unread(), ["Message 0", "Message 1", "Message 1"])
+        self._add(2, level=INFO_PERSISTENT)
+        self.assertEqual(Message.objects.filter(read=False).count(), 3)
+        self.assertEqual(Message.objects.filter(read=False, level=WARNING_PERSISTENT).count(), 1)
+
+    @override_settings(MESSAGES_PERSISTENT_MAX_UNREAD=2)
+    def test_cap_bulk_add(self):
+        other = User.objects.create(username="john")
+        for i in range(3):
+            messages_extends.bulk_add([self.user, other], WARNING_PERSISTENT, "Bulk %s" % i)
+        self.assertEqual(Message.objects.filter(read=False, user=other).count(), 2)
+        self.assertEqual(self._unread(), ["Bulk 1", "Bulk 1", "Bulk 2", "Bulk 2"])
+
+    @override_settings(MESSAGES_PERSISTENT_MAX_SHOWN=2, MESSAGES_BROADCASTS=True)
+    def test_max_shown(self):
+        self._add(5)
+        messages_extends.broadcast(WARNING_PERSISTENT, "Everybody")
+        storage = default_storage(self._request())
+        self.assertEqual([str(message) for message in storage], ["Message 4", "Everybody"])
+        self.assertEqual(storage.hidden_count, 4)
+        rendered = Template('{% include "messages_extends/includes/alerts_bootstrap.html" %}').\
+            render(Context({'messages': default_storage(self._request())}))
+        self.assertIn("4 more messages", rendered)
+        rendered = Template('{% load messages_extends_tags %}{% render_alerts %}').\
+            render(Context({'messages': default_storage(self._request())}))
+        self.assertIn("4 more messages", rendered)
+
+    @override_settings(MESSAGES_PERSISTENT_MAX_SHOWN=10, MESSAGES_BROADCASTS=True)
+    def test_max_shown_not_reached(self):
+        self._add(2)
+        storage = default_storage(self._request())
+        with self.assertNumQueries(2):
+            self.assertEqual(len(list(storage)), 2)
+        self.assertEqual(storage.hidden_count, 0)
+
+
+class ArchiveTests(TestCase):
+    client_class = MessagesClient
+
+    def setUp(self):
+        self.user = User.objects.create(username="bob")
+        self.user.set_password('password')
+        self.user.save()
+        self.client.login(username="bob", password='password')
+        old = timezone.now() - datetime.timedelta(days=40)
+        self.messages = [Message.objects.create(user=self.user, level=WARNING_PERSISTENT,
+                                                message="Message %s" % i) for i in range(4)]
+        Message.objects.filter(pk__in=[self.messages[0].pk, self.messages[1].pk]).\
+            update(read=True, created=old)
+        Message.objects.filter(pk=self.messages[2].pk).update(created=old)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('archive_messages', '--days', '30', '--batch-size', '1', stdout=out)
+        self.assertIn('Archived 2 messages.', out.getvalue())
+        self.assertEqual(sorted(ArchivedMessage.objects.values_list('pk', flat=True)),
+                         [self.messages[0].pk, self.messages[1].pk])
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('archive_messages', '--dry-run', stdout=out)
+        self.assertIn('2 messages would be archived.', out.getvalue())
+        self.assertFalse(ArchivedMessage.objects.exists())
+
+    def test_list_includes_archive(self):
+        call_command('archive_messages', stdout=StringIO())
+        url = reverse('messages:message_list')
+        data = self.client.get(url, {'fields': 'id', 'limit': 2}).json()
+        ids = [item['id'] for item in data['messages']]
+        data = self.client.get(url, {'fields': 'id', 'limit': 2, 'cursor': data['next']}).json()
+        ids += [item['id'] for item in data['messages']]
+        self.assertIsNone(data['next'])
+        self.assertEqual(ids, [message.pk for message in reversed(self.messages)])
+        data = self.client.get(url, {'fields': 'id', 'read': '0'}).json()
+        self.assertEqual(len(data['messages']), 2)
+
+    @override_settings(MESSAGES_ARCHIVE_ON_READ=True, MESSAGES_ARCHIVE_AFTER_DAYS=0)
+    def test_archive_on_read(self):
+        url = reverse('messages:message_mark_read', kwargs={'message_id': self.messages[3].pk})
+        self.client.get(url)
+        # Only the message just read, not the older read ones.
+        self.assertEqual(list(ArchivedMessage.objects.values_list('pk', flat=True)),
+                         [self.messages[3].pk])
+        # Marking an archived message again is not an error.
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.get(reverse('messages:message_mark_all_read'))
+        self.assertEqual(sorted(Message.objects.values_list('pk', flat=True)),
+                         [self.messages[0].pk, self.messages[1].pk])
+        self.assertEqual(counters.get_unread_count(self.user), 0)
+
+    @override_settings(MESSAGES_ARCHIVE_ON_READ=True)
+    def test_archive_on_read_threshold(self):
+        self.client.get(reverse('messages:message_mark_all_read'))
+        self.assertEqual(list(ArchivedMessage.objects.values_list('pk', flat=True)),
+                         [self.messages[2].pk])
+
+
+class CompactCookieStorageTests(TestCase):
+
+    def _storage(self, cookies=None):
+        req = RequestFactory().get("/")
+        req.COOKIES.update(cookies or {})
+        return CompactCookieStorage(req)
+
+    def _messages(self, count):
+        return [DjangoMessage(messages.INFO, "Your changes to item %s were saved." % i)
+                for i in range(count)]
+
+    def test_round_trip(self):
+        stored = [DjangoMessage(messages.INFO, "Plain"),
+                  DjangoMessage(messages.ERROR, mark_safe("<b>Safe</b>"), extra_tags="tag"),
+                  DjangoMessage(55, "Custom level")]
+        response = HttpResponse()
+        self.assertEqual(self._storage()._store(list(stored), response), [])
+        cookie = response.cookies[CompactCookieStorage.cookie_name].value
+        loaded = list(self._storage({CompactCookieStorage.cookie_name: cookie}))
+        self.assertEqual(loaded, stored)
+        self.assertIsInstance(loaded[1].message, SafeData)
+        self.assertEqual(loaded[1].extra_tags, "tag")
+        self.assertEqual(loaded[2].level, 55)
+
+    def test_tampered(self):
+        storage = self._storage({CompactCookieStorage.cookie_name: 'garbage:abc'})
+        self.assertEqual(list(storage), [])
+        self.assertTrue(storage.used)
+
+    def test_smaller_than_cookie_storage(self):
+        compact = self._storage()._encode(self._messages(20))
+        default = CookieStorage(RequestFactory().get("/"))._encode(self._messages(20))
+        self.assertLess(len(compact), len(default))
+
+    def test_overflow(self):
+        storage = self._storage()
+        storage.max_cookie_size = 300
+        response = HttpResponse()
+        unstored = storage._store(self._messages(100), response, remove_oldest=False)
+        cookie = response.cookies[CompactCookieStorage.cookie_name].value
+        self.assertLessEqual(len(cookie), 300)
+        loaded, all_retrieved = self._storage({CompactCookieStorage.cookie_name: cookie})._get()
+        self.assertFalse(all_retrieved)
+        # The oldest messages are kept, the newest ones are left to the next backend.
+        self.assertEqual(loaded + unstored, self._messages(100))
+        self.assertTrue(loaded)
+
+
+class DedupKeyTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="bob")
+
+    def _storage(self):
+        req = RequestFactory().get("/")
+        req.user = self.user
+        return PersistentStorage(req)
+
+    def test_single(self):
+        for i in range(3):
+            with self.captureOnCommitCallbacks(execute=True):
+                self._storage().add(WARNING_PERSISTENT, "Job failed", dedup_key="job-1")
+        self._storage().add(WARNING_PERSISTENT, "Job failed")
+        self.assertEqual(Message.objects.filter(dedup_key="job-1").count(), 1)
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(counters.get_unread_count(self.user), 2)
+
+    @override_settings(MESSAGES_PERSISTENT_DEFERRED=True)
+    def test_deferred(self):
+        Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Old",
+                               dedup_key="job-1")
+        storage = self._storage()
+        storage.add(WARNING_PERSISTENT, "Again", dedup_key="job-1")
+        storage.add(WARNING_PERSISTENT, "New", dedup_key="job-2")
+        storage.add(WARNING_PERSISTENT, "New twice", dedup_key="job-2")
+        storage.update(HttpResponse())
+        self.assertEqual(sorted(Message.objects.values_list('message', flat=True)), ["New", "Old"])
+
+    def test_bulk_add(self):
+        other = User.objects.create(username="john")
+        messages_extends.bulk_add([self.user], WARNING_PERSISTENT, "Release", dedup_key="v1")
+        created = messages_extends.bulk_add([self.user, other], WARNING_PERSISTENT, "Release",
+                                            dedup_key="v1")
+        self.assertEqual(created, 1)
+        self.assertEqual(Message.objects.filter(user=other).count(), 1)
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(counters.get_unread_count(self.user), 1)
+
+    def test_insert_messages_returns_inserted(self):
+        Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Old",
+                               dedup_key="a")
+        objs = [Message(user=self.user, level=WARNING_PERSISTENT, message=text, dedup_key=key)
+                for text, key in (("Dup", "a"), ("New", "b"), ("Plain", None))]
+        inserted = insert_messages(objs)
+        self.assertEqual([message.message for message in inserted], ["New", "Plain"])
+        self.assertTrue(all(message.pk for message in inserted))
+
+    def test_insert_messages_same_timestamp(self):
+        now = timezone.now()
+        with mock.patch('django.utils.timezone.now', return_value=now):
+            old = Message.objects.create(user=self.user, level=WARNING_PERSISTENT,
+                                         message="Old", dedup_key="a")
+            objs = [Message(user=self.user, level=WARNING_PERSISTENT, message="Dup",
+                            dedup_key="a")]
+            self.assertEqual(insert_messages(objs), [])
+        self.assertIsNone(objs[0].pk)
+        self.assertEqual(Message.objects.get().pk, old.pk)
+
+
+@override_settings(MESSAGES_PERSISTENT_OUTBOX=True, MESSAGES_OUTBOX_SYNC=True)
+class OutboxStorageTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="bob")
+        req = RequestFactory().get("/")
+        req.user = self.user
+        self.storage = PersistentStorage(req)
+
+    def test_written_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.storage.add(WARNING_PERSISTENT, "Later")
+        self.assertFalse(Message.objects.exists())
+        for callback in callbacks:
+            callback()
+        self.assertEqual(Message.objects.get().message, "Later")
+        self.assertEqual(counters.get_unread_count(self.user), 1)
+
+    @override_settings(MESSAGES_PERSISTENT_DEFERRED=True)
+    def test_deferred(self):
+        self.storage.add(WARNING_PERSISTENT, "One")
+        self.storage.add(WARNING_PERSISTENT, "Two")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.storage.update(HttpResponse())
+        self.assertEqual(list(Message.objects.order_by('pk').values_list('message', flat=True)),
+                         ["One", "Two"])
+
+
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.written = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.outbox = outbox.Outbox(workers=1, maxsize=1, write=self.write)
+
+    def tearDown(self):
+        self.release.set()
+        self.outbox.shutdown()
+
+    def write(self, messages):
+        if threading.current_thread().name.startswith('messages-outbox'):
+            self.started.set()
+            self.release.wait(5)
+        self.written.append(messages)
+
+    def test_batches_and_flush(self):
+        self.release.set()
+        self.outbox.put(["a"])
+        self.outbox.put(["b"])
+        self.outbox.flush()
+        self.assertEqual(sorted(sum(self.written, [])), ["a", "b"])
+
+    def test_full_writes_in_caller(self):
+        self.outbox.put(["a"])
+        self.started.wait(5)
+        self.outbox.put(["b"])
+        self.outbox.put(["c"])
+        self.assertIn(["c"], self.written)
+        self.release.set()
+        self.outbox.flush()
+        self.assertEqual(sorted(sum(self.written, [])), ["a", "b", "c"])
+
+    @override_settings(MESSAGES_OUTBOX_FULL='drop')
+    def test_full_drops(self):
+        self.outbox.put(["a"])
+        self.started.wait(5)
+        self.outbox.put(["b"])
+        with self.assertLogs('messages_extends.outbox', 'WARNING'):
+            self.outbox.put(["c"])
+        self.release.set()
+        self.outbox.flush()
+        self.assertEqual(len(sum(self.written, [])), 2)
+
+    def test_shutdown_drains(self):
+        self.outbox.put(["a"])
+        self.release.set()
+        self.outbox.shutdown()
+        self.assertEqual(self.written, [["a"]])
+        self.outbox.put(["b"])
+        self.assertEqual(self.written, [["a"], ["b"]])
+
+
+@override_settings(MESSAGES_READ_DATABASE='replica')
+class ReadReplicaTests(TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create_user("bob", password="password")
+        self.client.login(username="bob", password="password")
+
+    def _storage(self):
+        req = RequestFactory().get("/")
+        req.user = self.user
+        return PersistentStorage(req)
+
+    def test_reads_replica(self):
+        Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Lagging")
+        with CaptureQueriesContext(connections['replica']) as queries:
+            self.assertEqual(list(self._storage()), [])
+        self.assertTrue(queries.captured_queries)
+        response = self.client.get(reverse('messages:message_list'))
+        self.assertEqual(response.json()['messages'], [])
+
+    def test_sticky_after_write(self):
+        self._storage().add(WARNING_PERSISTENT, "Just added")
+        self.assertEqual([message.message for message in self._storage()], ["Just added"])
+        response = self.client.get(reverse('messages:message_list'))
+        self.assertEqual(len(response.json()['messages']), 1)
+
+    def test_sticky_after_mark_read(self):
+        message = Message.objects.create(user=self.user, level=WARNING_PERSISTENT,
+                                         message="Dismissed")
+        # Replicated, but the update won't be.
+        User.objects.using('replica').create(pk=self.user.pk, username="bob")
+        Message.objects.using('replica').create(pk=message.pk, user_id=self.user.pk,
+                                                level=WARNING_PERSISTENT, message="Dismissed")
+        self.assertEqual(len(list(self._storage())), 1)
+        self.client.get(reverse('messages:message_mark_read', args=[message.pk]))
+        self.assertEqual(list(self._storage()), [])
+        caches['default'].clear()
+        self.assertEqual(len(list(self._storage())), 1)
+
+    @override_settings(MESSAGES_PERSISTENT_CACHE='default')
+    def test_cache_filled_from_primary(self):
+        Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Cached")
+        self.assertEqual(len(list(self._storage())), 1)
+
+
+class MessageAdminTests(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username="admin", password="password")
+        self.users = [User.objects.create(username="user%d" % i) for i in range(5)]
+        for user in self.users:
+            Message.objects.create(user=user, level=WARNING_PERSISTENT, message="Hi")
+        self.url = reverse('admin:messages_extends_message_changelist')
+
+    def _action(self, action, messages):
+        return self.client.post(self.url, {'action': action,
+                                           '_selected_action': [message.pk for message in messages]})
+
+    def test_changelist_joins_users(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+            count = len(queries)
+        self.assertContains(response, "user4")
+        for user in self.users:
+            Message.objects.create(user=user, level=WARNING_PERSISTENT, message="Again")
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+            self.assertEqual(len(queries), count)
+
+    def test_search(self):
+        message = Message.objects.filter(user=self.users[2]).get()
+        response = self.client.get(self.url, {'q': 'user2'})
+        self.assertEqual(list(response.context['cl'].result_list), [message])
+        response = self.client.get(self.url, {'q': str(message.pk)})
+        self.assertIn(message, response.context['cl'].result_list)
+        response = self.client.get(self.url, {'q': 'Hi'})
+        self.assertEqual(len(response.context['cl'].result_list), 0)
+
+    def test_mark_read(self):
+        self.assertEqual(counters.get_unread_count(self.users[0]), 1)
+        self._action('mark_read', Message.objects.filter(user__in=self.users[:2]))
+        self.assertEqual(Message.objects.filter(read=True).count(), 2)
+        self.assertEqual(counters.get_unread_count(self.users[0]), 0)
+
+    def test_expire(self):
+        self._action('expire', Message.objects.filter(user=self.users[0]))
+        self.assertEqual(Message.objects.filter(expires__lte=timezone.now()).count(), 1)
+        self.assertEqual(counters.get_unread_count(self.users[0]), 0)
+
+    def test_purge_keeps_unread(self):
+        Message.objects.filter(user=self.users[0]).update(read=True)
+        with CaptureQueriesContext(connection) as queries:
+            self._action('purge', Message.objects.all())
+            deletes = [query for query in queries
+                       if query['sql'].startswith('DELETE FROM "messages_extends_message"')]
+        self.assertEqual(len(deletes), 1)
+        self.assertEqual(Message.objects.count(), 4)
+
+    def test_estimated_count(self):
+        paginator = EstimatedCountPaginator(Message.objects.order_by('-pk'), 100)
+        with mock.patch('messages_extends.admin.estimate_count', return_value=12345678):
+            self.assertEqual(paginator.count, 12345678)
+        # Small estimates are checked with an exact count.
+        filtered = EstimatedCountPaginator(Message.objects.filter(read=False).order_by('-pk'),
+                                           100)
+        with mock.patch('messages_extends.admin.estimate_count', return_value=10):
+            self.assertEqual(filtered.count, 5)
+        # SQLite has no estimates.
+        self.assertIsNone(estimate_count(Message.objects.filter(read=False)))
+
+
+class MessageTagTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="bob")
+        req = RequestFactory().get("/")
+        req.user = self.user
+        self.storage = PersistentStorage(req)
+
+    def _tags(self):
+        return sorted(MessageTag.objects.values_list('message__message', 'tag'))
+
+    def test_maintained(self):
+        self.storage.add(WARNING_PERSISTENT, "Invoice", extra_tags="billing urgent billing")
+        self.storage.add(WARNING_PERSISTENT, "Untagged")
+        messages_extends.bulk_add([self.user], WARNING_PERSISTENT, "Card", extra_tags="billing")
+        self.assertEqual(self._tags(), [("Card", "billing"), ("Invoice", "billing"),
+                                        ("Invoice", "urgent")])
+        message = Message.objects.get(message="Invoice")
+        message.extra_tags = "urgent"
+        message.save()
+        self.assertEqual(self._tags(), [("Card", "billing"), ("Invoice", "urgent")])
+        message.delete()
+        self.assertEqual(self._tags(), [("Card", "billing")])
+
+    def test_lookups(self):
+        other = User.objects.create(username="john")
+        messages_extends.bulk_add([self.user, other], WARNING_PERSISTENT, "Card",
+                                  extra_tags="billing")
+        self.storage.add(WARNING_PERSISTENT, "Hello", extra_tags="billing-info")
+        self.assertEqual(tags.count("billing"), 2)
+        self.assertEqual(tags.count("billing", self.user), 1)
+        self.assertEqual(counters.get_unread_count(self.user), 2)
+        self.assertEqual(tags.mark_read("billing", batch_size=1), 2)
+        self.assertEqual(tags.count("billing"), 0)
+        self.assertEqual(tags.tagged("billing", include_read=True).count(), 2)
+        self.assertEqual(counters.get_unread_count(self.user), 1)
+
+    def test_unchanged_tags_kept(self):
+        self.storage.add(WARNING_PERSISTENT, "Invoice", extra_tags="billing")
+        message = Message.objects.get(message="Invoice")
+        tag_pks = list(MessageTag.objects.values_list('pk', flat=True))
+        message.read = True
+        message.save()
+        self.assertEqual(list(MessageTag.objects.values_list('pk', flat=True)), tag_pks)
+
+    def test_expired_left_out(self):
+        self.storage.add(WARNING_PERSISTENT, "Card", extra_tags="billing")
+        Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Old",
+                               extra_tags="billing",
+                               expires=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(tags.count("billing"), 1)
+        self.assertEqual(tags.mark_read("billing"), 1)
+        self.assertFalse(Message.objects.get(message="Old").read)
+
+    def test_bulk_add_without_returned_pks(self):
+        # As on MySQL, the rows are found by their insert tokens.
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert',
+                               False):
+            messages_extends.bulk_add([self.user], WARNING_PERSISTENT, "Card",
+                                      extra_tags="billing")
+        self.assertEqual(self._tags(), [("Card", "billing")])
+        self.assertEqual(tags.mark_read("billing"), 1)
+
+    def test_rebuild_batches(self):
+        self.storage.add(WARNING_PERSISTENT, "Invoice", extra_tags="billing")
+        self.storage.add(WARNING_PERSISTENT, "Card", extra_tags="billing urgent")
+        Message.objects.filter(message="Invoice").update(extra_tags="")
+        self.assertEqual(tags.rebuild_all(batch_size=1), 2)
+        self.assertEqual(self._tags(), [("Card", "billing"), ("Card", "urgent")])
+
+    def test_rebuild(self):
+        Message.objects.create(user=self.user, level=WARNING_PERSISTENT, message="Old")
+        Message.objects.filter(message="Old").update(extra_tags="legacy billing")
+        out = StringIO()
+        call_command('rebuild_message_tags', stdout=out)
+        self.assertIn("Rebuilt 2 message tags.", out.getvalue())
+        self.assertEqual(tags.count("legacy"), 1)
@@ -1,6 +1,11 @@
 from django.conf.urls import include
+from django.contrib import admin
 from django.urls import path
 
 urlpatterns = [
+    path('admin/', admin.site.urls),
     path('messages/', include(('messages_extends.urls', 'messages'))),
+    path('async-messages/', include(('messages_extends.async_urls', 'async_messages'))),
+    # The bundled templates reverse the urls without a namespace.
+    path('plain-messages/', include('messages_extends.urls')),
 ]